@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# file: mailbench.py
+# author: kyle isom <coder@kyleisom.net>
+# license: ISC / public domain dual-licensed
+#
+# benchmarks for the mailer module
+
+"""
+mailbench
+
+Benchmarks for the mailer module. Each benchmark returns a list of result
+dictionaries, and running the module prints them one JSON object per line
+so they can be compared between runs:
+
+    python mailbench.py validate
+
+Benchmarks:
+    validate: address list validation at increasing list sizes; the
+        per-address time should stay flat as the list grows.
+    merge: rendering personalised messages from a precompiled Template
+        against building each one with build_message.
+    send: delivery through simple, with_text, send_bulk, merge and
+        send_planned to an in-process SMTP sink, at a range of message
+        sizes, recipient counts and attachment sizes. Each result has
+        messages/sec, p50/p99 latency and the peak RSS so far.
+"""
+
+import asyncore
+import json
+import os
+import random
+import resource
+import smtpd
+import string
+import sys
+import tempfile
+import threading
+import time
+
+import mailer
+
+
+def address_list(size, distinct = None):
+    """
+    Build a list of size addresses, drawn from distinct different ones
+    (all different by default), with roughly one in ten invalid.
+    """
+    if not distinct:
+        distinct = size
+
+    addresses = [ ]
+    for i in range(size):
+        n = random.randint(0, distinct - 1)
+        if 0 == n % 10:
+            addresses.append('broken%d@bad.' % n)
+        else:
+            addresses.append('user%d@host%d.example.com' % (n, n % 97))
+    return addresses
+
+
+def bench_validate(sizes = (1000, 10000, 100000), distinct = None):
+    """
+    Time validate_addresses over lists of each size, with the verdict
+    cache cleared before each run (so only repeats within a list hit it).
+    """
+    results = [ ]
+    for size in sizes:
+        addresses = address_list(size, distinct)
+        mailer.verdicts.clear()
+
+        start = time.time()
+        to_string, accepted, rejects = mailer.validate_addresses(addresses)
+        elapsed = time.time() - start
+
+        results.append({ 'benchmark': 'validate', 'size': size,
+                         'distinct': distinct or size,
+                         'accepted': len(accepted),
+                         'rejected': len(rejects),
+                         'seconds': elapsed,
+                         'usec_per_address': elapsed / size * 1e6 })
+    return results
+
+
+MERGE_SUBJECT = 'Your $plan account statement for $month'
+MERGE_BODY    = '''Hello $name,
+
+Your $plan plan used $usage GB in $month. Your next invoice will be
+sent to $email.
+
+Thanks,
+the billing robot
+'''
+
+
+def merge_fields(count):
+    for i in range(count):
+        address = 'user%d@host%d.example.com' % (i, i % 97)
+        yield [ address ], { 'name': 'User %d' % i, 'plan': 'basic',
+                             'month': 'October', 'usage': i % 500,
+                             'email': address }
+
+
+def bench_merge(count = 10000):
+    """
+    Time rendering count personalised messages with Template.render and
+    with string formatting plus build_message and as_string().
+    """
+    mailer.set_sender('bench@example.com')
+    results = [ ]
+
+    start = time.time()
+    template = mailer.Template(MERGE_SUBJECT, MERGE_BODY)
+    for to_list, fields in merge_fields(count):
+        template.render(to_list, fields)
+    elapsed = time.time() - start
+    results.append({ 'benchmark': 'merge', 'path': 'template',
+                     'messages': count, 'seconds': elapsed,
+                     'messages_per_sec': count / elapsed })
+
+    subject = string.Template(MERGE_SUBJECT)
+    body    = string.Template(MERGE_BODY)
+    start   = time.time()
+    for to_list, fields in merge_fields(count):
+        mailer.build_message(to_list, subject.substitute(fields),
+                             body.substitute(fields)).as_string()
+    elapsed = time.time() - start
+    results.append({ 'benchmark': 'merge', 'path': 'build_message',
+                     'messages': count, 'seconds': elapsed,
+                     'messages_per_sec': count / elapsed })
+
+    return results
+
+
+class Sink (smtpd.SMTPServer):
+    """
+    SMTP server that accepts and counts every message, run on its own
+    thread. Messages aren't kept.
+    """
+    received = None
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.received = 0
+        self.__running = True
+        self.__thread  = threading.Thread(target = self.__serve__)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+    def __serve__(self):
+        while self.__running:
+            asyncore.loop(timeout = 0.05, count = 1)
+
+    def stop(self):
+        self.__running = False
+        self.__thread.join()
+        self.close()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(p * (len(values) - 1))]
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process so far, in kilobytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if 'darwin' == sys.platform:
+        rss /= 1024
+    return rss
+
+
+def report(path, params, latencies, elapsed, sink, expected):
+    result = { 'benchmark': 'send', 'path': path,
+               'messages': len(latencies),
+               'seconds': elapsed,
+               'messages_per_sec': len(latencies) / elapsed,
+               'p50_ms': percentile(latencies, 0.5) * 1000,
+               'p99_ms': percentile(latencies, 0.99) * 1000,
+               'peak_rss_kb': peak_rss(),
+               'delivered': sink.received == expected }
+    result.update(params)
+    return result
+
+
+def timed(func, count):
+    latencies = [ ]
+    start = time.time()
+    for i in range(count):
+        t = time.time()
+        func(i)
+        latencies.append(time.time() - t)
+    return latencies, time.time() - start
+
+
+def timed_bulk(send, items):
+    """
+    Time a bulk send, where latency runs from a message being taken from
+    the input to its delivery callback.
+    """
+    started   = { }
+    latencies = [ ]
+
+    def feed():
+        for i, item in enumerate(items):
+            started[i] = time.time()
+            yield item
+
+    def done(index, status, detail):
+        latencies.append(time.time() - started[index])
+
+    start = time.time()
+    send(feed(), done)
+    return latencies, time.time() - start
+
+
+def recipients(count, offset = 0, domains = 1):
+    return [ 'user%d@host%d.example.com' % (offset + i, i % domains)
+             for i in range(count) ]
+
+
+def bench_send(count = 200, sizes = (1024, 64 * 1024), rcpts = (1, 10),
+               attachments = (64 * 1024, 1024 * 1024), workers = (1, 4)):
+    """
+    Drive each send path against a local SMTP sink.
+    """
+    sink = Sink()
+    mailer.set_sender('bench@example.com')
+    mailer.set_transport(mailer.SMTPPool('127.0.0.1', sink.port()))
+    results = [ ]
+
+    try:
+        for size in sizes:
+            for n in rcpts:
+                sink.received = 0
+                body = 'x' * size
+                latencies, elapsed = timed(
+                    lambda i: mailer.simple(recipients(n, i), 'bench', body),
+                    count)
+                results.append(report('simple', { 'size': size,
+                                                  'recipients': n },
+                                      latencies, elapsed, sink, count))
+
+        for size in attachments:
+            fd, filename = tempfile.mkstemp()
+            try:
+                os.write(fd, ('y' * 75 + '\n') * (size / 76))
+                os.close(fd)
+
+                sink.received = 0
+                latencies, elapsed = timed(
+                    lambda i: mailer.with_text(recipients(1, i), 'bench',
+                                               'body', [ filename ]),
+                    count / 10)
+                results.append(report('with_text', { 'attachment': size },
+                                      latencies, elapsed, sink, count / 10))
+            finally:
+                os.unlink(filename)
+
+        template = mailer.Template(MERGE_SUBJECT, MERGE_BODY)
+        for n in workers:
+            sink.received = 0
+            messages = ((recipients(1, i), 'bench', 'body')
+                        for i in range(count))
+            latencies, elapsed = timed_bulk(
+                lambda items, done: mailer.send_bulk(items, workers = n,
+                                                     callback = done),
+                messages)
+            results.append(report('send_bulk', { 'workers': n },
+                                  latencies, elapsed, sink, count))
+
+            sink.received = 0
+            latencies, elapsed = timed_bulk(
+                lambda items, done: mailer.merge(template, items,
+                                                 workers = n,
+                                                 callback = done),
+                merge_fields(count))
+            results.append(report('merge', { 'workers': n },
+                                  latencies, elapsed, sink, count))
+
+        for n in rcpts:
+            sink.received = 0
+            to_list = recipients(n * 50, domains = 5)
+            message = mailer.build_message(list(to_list), 'bench', 'body')
+            latencies, elapsed = timed(
+                lambda i: mailer.send_planned(message, to_list,
+                                              max_rcpt = 50),
+                count / 20)
+            expected = (count / 20) * len(mailer.plan_delivery(to_list, 50))
+            results.append(report('send_planned', { 'recipients': n * 50 },
+                                  latencies, elapsed, sink, expected))
+    finally:
+        mailer.get_transport().close()
+        sink.stop()
+
+    return results
+
+
+BENCHMARKS = {
+    'validate': bench_validate,
+    'merge': bench_merge,
+    'send': bench_send,
+}
+
+
+def main(args):
+    names = args or sorted(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.stderr.write('!! mailbench: unknown benchmark ' + name + '\n')
+            return False
+        for result in BENCHMARKS[name]():
+            print json.dumps(result, sort_keys = True)
+    return True
+
+
+if __name__ == '__main__':
+    if not main(sys.argv[1:]):
+        sys.exit(1)
@@ -28,7 +28,16 @@ Important methods:
     build_message: build a mulitpart message base (for attaching
         attachments to)
     attach_text: attach text files to a message
+    attach_file: attach files of any type to a message
+    build_streaming: build a message whose attachments are encoded as it
+        is sent, for large files
     send: send an email
+    send_stream: send a message built with build_streaming
+    send_planned: send to a large recipient list in per-domain batches
+    send_bulk: send many messages in parallel
+    Template / merge: personalised messages from a precompiled template
+    enqueue: queue an email to be sent in the background (see set_spool)
+    set_transport: use a different SMTP server or connection pool
 
 If you plan on using some of the other internal functions, bear in mind that
 every function will return a True or False indicating success, except for
@@ -36,6 +45,8 @@ the following processing functions:
     sanitize - returns sanitized version of string
     check_tolist: checks a list of email addresses - returns a string of the
         email address (used by MIMEtext)
+    validate_addresses: checks a list of email addresses - returns the
+        header string, the accepted addresses and the rejected ones
     get_sender: returns a string containing the current sender
     toggle_local: always returns true
 
@@ -53,18 +64,43 @@ TODO:
 """
 
 
+from email import encoders
+from email.header import Header
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email.mime.audio import MIMEAudio
+import base64
+import binascii
+import collections
 import getopt
+import json
+import mimetypes
 import os
+import Queue
+import re
 import smtplib
+import socket
+import string
 import sys
+import threading
+import time
+import uuid
 
 sender = ["pymailer"]
 allow_local = False
 
+# verdicts on recently seen addresses, for validate_addresses
+verdict_cache_size = 65536
+verdicts = collections.OrderedDict()
+verdicts_lock = threading.Lock()
+
+NEWLINES = re.compile('[\r\n]')
+
+# the common user@host.domain form, which check_email always accepts
+SIMPLE_ADDRESS = re.compile(r'^[^@\[\]<>\s]+@[A-Za-z0-9-]+(\.[A-Za-z0-9-]+)+$')
+
 
 def sanitize(input_string):
     """
@@ -72,12 +108,7 @@ def sanitize(input_string):
     on multiple variables. Presently strips out leading and trailing
     whitespace, as well as newlines and carriage returns.
     """
-    input_string = input_string.strip()
-    input_string = input_string.replace('\n', '')
-    input_string = input_string.replace('\r', '')
-    input_string = input_string.replace('\x0a', '')
-    input_string = input_string.replace('\x0d', '')
-    return input_string
+    return NEWLINES.sub('', input_string.strip())
 
 
 def check_ipv4(ip):
@@ -160,37 +191,74 @@ def check_email(email):
 def check_tolist(to_list):
     """
         Checks the list of recipients. Returns a string of email addresses
-        in the format expected by smtplib.
+        in the format expected by smtplib. Bad addresses are reported on
+        stderr and removed from to_list.
     """
+    to_string, accepted, rejects = validate_addresses(to_list)
+    for index, address in rejects:
+        sys.stderr.write('!! mailer: bad address ' + address + '\n')
 
-    to_string = ""
-
-    # ensure addresses are in proper mailbox format
-    for i in range(0, len(to_list)):
-        address = to_list[i]
-        address = sanitize(address)
-
-        if not check_email(address):
-            sys.stderr.write('!! mailer: bad address ' + address + '\n')
-            to_list[i] = ''
-            continue
-        if not address[0] == '<':
-            address = "<" + address[:]
-        if not address[len(address) - 1] == ">":
-            address = address[:] + ">"
+    to_list[:] = accepted
+    return to_string
 
-        to_list[i] = address
 
-    while '' in to_list:
-        to_list.remove('')
+def verdict(address):
+    """
+    Sanitize and check a single address, returning the address in angle
+    brackets or None if it isn't valid. Results are cached.
+    """
+    key = (address, allow_local)
+    with verdicts_lock:
+        result = verdicts.pop(key, False)
+        if result is not False:
+            verdicts[key] = result
+            return result
+
+    clean = sanitize(address)
+    if SIMPLE_ADDRESS.match(clean):
+        valid = True
+    else:
+        try:
+            valid = check_email(clean)
+        except IndexError:                  # empty domain or address
+            valid = False
+
+    result = None
+    if valid:
+        if not clean.startswith('<'):
+            clean = '<' + clean
+        if not clean.endswith('>'):
+            clean = clean + '>'
+        result = clean
+
+    with verdicts_lock:
+        verdicts[key] = result
+        while len(verdicts) > verdict_cache_size:
+            verdicts.popitem(last = False)
+    return result
+
+
+def validate_addresses(addresses):
+    """
+        validate_addresses(addresses)
 
-    for i in range(0, len(to_list)):
-        to_string = to_string + to_list[i] + ", "
+        Checks a list of email addresses in a single pass, without
+        modifying it. Returns a tuple of the header string of accepted
+        addresses (as check_tolist returns), the list of accepted
+        addresses in angle brackets, and a list of (index, address) tuples
+        for the rejected addresses (sanitized).
+    """
+    accepted = [ ]
+    rejects  = [ ]
 
-    # remove final comma and space
-    to_string = to_string[:-2]
+    for index, address in enumerate(addresses):
+        result = verdict(address)
+        if result:
+            accepted.append(result)
+        else:
+            rejects.append((index, sanitize(address)))
 
-    return to_string
+    return ', '.join(accepted), accepted, rejects
 
 def build_message(to_list, subject = "", body = ""):
     if not to_list:
@@ -212,18 +280,326 @@ def build_message(to_list, subject = "", body = ""):
 
     return mail
 
+class SMTPPool:
+    """
+    Pool of persistent SMTP sessions. Sessions are connected, EHLO'd and
+    (if a username is given) authenticated once, then reused for up to
+    max_messages messages before being replaced. A session the server
+    has dropped is reconnected and the message retried once. At most
+    max_size idle sessions are kept; the pool is safe to share across
+    threads.
+    """
+    host         = None
+    port         = None
+    username     = None
+    password     = None
+    starttls     = None
+    timeout      = None
+    max_size     = None
+    max_messages = None
+
+    def __init__(self, host = 'localhost', port = 25, username = None,
+                 password = None, starttls = False, timeout = 60,
+                 max_size = 4, max_messages = 100):
+        self.host         = host
+        self.port         = port
+        self.username     = username
+        self.password     = password
+        self.starttls     = starttls
+        self.timeout      = timeout
+        self.max_size     = max_size
+        self.max_messages = max_messages
+        self.__lock       = threading.Lock()
+        self.__idle       = [ ]
+
+    def connect(self):
+        """
+        Open and set up a new session.
+        """
+        session = smtplib.SMTP(self.host, self.port, timeout = self.timeout)
+        try:
+            session.ehlo()
+            if self.starttls:
+                session.starttls()
+                session.ehlo()
+            if self.username:
+                session.login(self.username, self.password)
+        except:
+            self.discard(session)
+            raise
+
+        session.messages_sent = 0
+        return session
+
+    def clone(self, max_size = None):
+        """
+        Return a new, empty pool with the same server settings.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        return SMTPPool(self.host, self.port, self.username, self.password,
+                        self.starttls, self.timeout, max_size,
+                        self.max_messages)
+
+    def acquire(self):
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop()
+        return self.connect()
+
+    def release(self, session):
+        if session.messages_sent < self.max_messages:
+            with self.__lock:
+                if len(self.__idle) < self.max_size:
+                    self.__idle.append(session)
+                    return
+        self.discard(session)
+
+    def discard(self, session):
+        try:
+            session.quit()
+        except (smtplib.SMTPException, IOError):
+            session.close()
+
+    def sendmail(self, from_addr, to_list, message):
+        """
+        Send a message over a pooled session, returning the dictionary of
+        refused recipients as smtplib's sendmail does.
+        """
+        session = self.acquire()
+        try:
+            try:
+                refused = session.sendmail(from_addr, to_list, message)
+            except smtplib.SMTPServerDisconnected:
+                session.close()
+                session = self.connect()
+                refused = session.sendmail(from_addr, to_list, message)
+        except smtplib.SMTPServerDisconnected:
+            session.close()
+            raise
+        except smtplib.SMTPException:
+            # the session is still usable, but reset any half-finished
+            # transaction before it goes back into the pool.
+            error = sys.exc_info()
+            try:
+                session.rset()
+                self.release(session)
+            except (smtplib.SMTPException, IOError):
+                session.close()
+            raise error[0], error[1], error[2]
+        except:
+            session.close()
+            raise
+
+        session.messages_sent += 1
+        self.release(session)
+        return refused
+
+    def sendstream(self, from_addr, to_list, chunks):
+        """
+        Like sendmail, but the message is an iterable of chunks, each made
+        up of whole lines, which are written to the DATA stream as they
+        are produced.
+        """
+        session = self.acquire()
+        try:
+            try:
+                session.ehlo_or_helo_if_needed()
+                code, resp = session.mail(from_addr)
+            except smtplib.SMTPServerDisconnected:
+                session.close()
+                session = self.connect()
+                code, resp = session.mail(from_addr)
+
+            refused = self.__data__(session, from_addr, to_list, code,
+                                    resp, chunks)
+        except smtplib.SMTPServerDisconnected:
+            session.close()
+            raise
+        except smtplib.SMTPException:
+            error = sys.exc_info()
+            try:
+                session.rset()
+                self.release(session)
+            except (smtplib.SMTPException, IOError):
+                session.close()
+            raise error[0], error[1], error[2]
+        except:
+            # the DATA stream may have been left half-written
+            session.close()
+            raise
+
+        session.messages_sent += 1
+        self.release(session)
+        return refused
+
+    def __data__(self, session, from_addr, to_list, code, resp, chunks):
+        if 250 != code:
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+        refused = { }
+        for address in to_list:
+            code, resp = session.rcpt(address)
+            if code not in (250, 251):
+                refused[address] = (code, resp)
+        if len(refused) == len(to_list):
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = session.docmd('data')
+        if 354 != code:
+            raise smtplib.SMTPDataError(code, resp)
+
+        buf  = [ ]
+        size = 0
+        for chunk in chunks:
+            chunk = smtplib.quotedata(chunk)
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= 64 * 1024:
+                session.send(''.join(buf))
+                buf  = [ ]
+                size = 0
+
+        tail = ''.join(buf)
+        if tail and not tail.endswith('\r\n'):
+            tail += '\r\n'
+        session.send(tail + '.\r\n')
+
+        code, resp = session.getreply()
+        if 250 != code:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def close(self):
+        """
+        Close every idle session in the pool.
+        """
+        with self.__lock:
+            idle = self.__idle
+            self.__idle = [ ]
+
+        for session in idle:
+            self.discard(session)
+
+
+transport = [ SMTPPool() ]
+
+
+def set_transport(pool):
+    """
+    Replace the SMTP connection pool used to send mail, closing the old
+    one. Returns True.
+    """
+    old = transport[0]
+    transport[0] = pool
+    old.close()
+    return True
+
+
+def get_transport():
+    return transport[0]
+
+
 def send(email, to_list):
-    s = smtplib.SMTP()
     try:
-        s.connect('localhost')
-        s.sendmail(get_sender(), to_list, email.as_string())
-    except smtplib.SMTPException as e:
+        get_transport().sendmail(get_sender(), to_list, email.as_string())
+    except (smtplib.SMTPException, IOError) as e:
         print e
         return False
     else:
         return True
 
 
+def recipient_domain(address):
+    """
+    Return the lower-cased domain of an address, or '' for a local one.
+    """
+    address = address.strip('<>')
+    if '@' not in address:
+        return ''
+    return address.rsplit('@', 1)[1].lower()
+
+
+def plan_delivery(to_list, max_rcpt = 100, route = None):
+    """
+        plan_delivery(to_list, max_rcpt = 100, route = None)
+
+        Group recipients by domain and split each group into envelopes of
+        no more than max_rcpt recipients. route, if given, maps a domain
+        to the key recipients are grouped on (i.e. its MX host), so that
+        domains sharing a mail server share envelopes. Returns a list of
+        (key, recipients) tuples.
+    """
+    if not route:
+        route = lambda domain: domain
+
+    groups = collections.OrderedDict()
+    for address in to_list:
+        key = route(recipient_domain(address))
+        groups.setdefault(key, [ ]).append(address)
+
+    plan = [ ]
+    for key, addresses in groups.items():
+        for i in range(0, len(addresses), max_rcpt):
+            plan.append((key, addresses[i:i + max_rcpt]))
+    return plan
+
+
+def send_planned(email, to_list, max_rcpt = 100, workers = 4, route = None):
+    """
+        send_planned(email, to_list, max_rcpt = 100, workers = 4,
+                     route = None)
+
+        Send email to a large recipient list, split into envelopes by
+        plan_delivery and sent over up to workers connections at once.
+        Returns a dictionary of the recipients that weren't accepted,
+        mapping each to the (code, response) the server gave or, if the
+        whole envelope failed, (None, error message). An empty dictionary
+        means every recipient was accepted.
+    """
+    plan    = Queue.Queue()
+    refused = { }
+    lock    = threading.Lock()
+    message = email
+    if not isinstance(message, basestring):
+        message = message.as_string()
+
+    for envelope in plan_delivery(to_list, max_rcpt, route):
+        plan.put(envelope)
+
+    def work():
+        while True:
+            try:
+                key, recipients = plan.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                failed = get_transport().sendmail(get_sender(), recipients,
+                                                  message)
+            except smtplib.SMTPRecipientsRefused as e:
+                failed = e.recipients
+            except (smtplib.SMTPException, IOError) as e:
+                sys.stderr.write('!! mailer: sending to %s failed: %s\n'
+                                 % (key, e))
+                failed = dict([ (address, (None, str(e)))
+                                for address in recipients ])
+
+            if failed:
+                with lock:
+                    refused.update(failed)
+
+    threads = [ threading.Thread(target = work)
+                for i in range(max(1, min(workers, plan.qsize()))) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return refused
+
+
 def simple(to_list, subject = "", body = ""):
     """
         simple(to_list = [], subject = "mailer.py", body = "")
@@ -286,11 +662,16 @@ def local_allowed():
 def with_text(to_list, subject = "", body = "", file_list = []):
     """
         Build a multipart message with the plain text files specified in
-        file_list and send that off to the wide wide world.
+        file_list and send that off to the wide wide world. The files are
+        encoded as the message is sent, rather than read in up front.
     """
-    mail = build_message(to_list, subject, body)
-    mail = attach_text(mail, file_list)
-    return send(mail, to_list)
+    mail = build_streaming(to_list, subject, body)
+    if not mail:
+        return False
+
+    for file in file_list:
+        mail.attach(file, 'text/plain')
+    return send_stream(mail, to_list)
 
 
 def attach_text(mail, file_list):
@@ -306,14 +687,776 @@ def attach_text(mail, file_list):
         except IOError as e:
             print e
             print 'failed to attach', file
-            pass
+            continue
         txt = MIMEText(f.read())
+        f.close()
         txt.add_header('Content-Disposition', 'attachment',
                        filename = os.path.basename(file))
         mail.attach(txt)
 
     return mail
 
+
+def attachment_type(filename):
+    """
+    Guess a file's MIME type from its name, returning the main type and
+    subtype. Unknown (or compressed) files are application/octet-stream.
+    """
+    ctype, encoding = mimetypes.guess_type(filename)
+    if not ctype or encoding:
+        ctype = 'application/octet-stream'
+    return ctype.split('/', 1)
+
+
+def attach_file(mail, file_list):
+    """
+        Like attach_text, but for files of any type: images and audio are
+        attached as MIMEImage and MIMEAudio parts, text files as MIMEText,
+        and anything else base64-encoded as application/octet-stream.
+        Each file is read into memory; use build_streaming for large
+        files.
+    """
+    for file in file_list:
+        try:
+            f = open(file, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError as e:
+            print e
+            print 'failed to attach', file
+            continue
+
+        maintype, subtype = attachment_type(file)
+        if 'text' == maintype:
+            part = MIMEText(data, subtype)
+        elif 'image' == maintype:
+            part = MIMEImage(data, subtype)
+        elif 'audio' == maintype:
+            part = MIMEAudio(data, subtype)
+        else:
+            part = MIMEBase(maintype, subtype)
+            part.set_payload(data)
+            encoders.encode_base64(part)
+        part.add_header('Content-Disposition', 'attachment',
+                        filename = os.path.basename(file))
+        mail.attach(part)
+
+    return mail
+
+
+def encode_base64(f, chunk_size):
+    # chunk_size is a multiple of 57 bytes, so every chunk encodes to
+    # whole 76 character lines.
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield base64.encodestring(chunk)
+
+
+def encode_qp(f, chunk_size):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        if not chunk.endswith('\n'):
+            chunk += f.readline(chunk_size)
+
+        # a chunk ending mid-line gets a soft line break, so the decoder
+        # joins it back up with the next one.
+        encoded = binascii.b2a_qp(chunk)
+        if not encoded.endswith('\n'):
+            encoded += '=\n'
+        yield wrap_qp(encoded)
+
+
+QP_LINE = 76
+
+
+def wrap_qp(encoded):
+    # b2a_qp can produce lines longer than RFC 2045 allows, and so can
+    # adding a soft line break above; split them with more soft breaks,
+    # never inside an =XX escape.
+    lines = encoded.split('\n')
+    if max([ len(line) for line in lines ]) <= QP_LINE:
+        return encoded
+
+    wrapped = [ ]
+    for line in lines:
+        while len(line) > QP_LINE:
+            cut = QP_LINE - 1
+            if '=' == line[cut - 1]:
+                cut -= 1
+            elif '=' == line[cut - 2]:
+                cut -= 2
+            wrapped.append(line[:cut] + '=')
+            line = line[cut:]
+        wrapped.append(line)
+    return '\n'.join(wrapped)
+
+
+class StreamingMessage:
+    """
+    Multipart message whose attachments are read from disk and encoded a
+    chunk at a time while the message is being sent, so memory use
+    doesn't grow with the size of the attachments. Text files are
+    quoted-printable encoded, anything else base64. Build one with
+    build_streaming and send it with send_stream; lines() can only be
+    consumed once.
+    """
+    chunk_size = 57 * 1024
+    to_string  = None
+    subject    = None
+    body       = None
+    boundary   = None
+    files      = None
+
+    def __init__(self, to_string, subject, body):
+        self.to_string = to_string
+        self.subject   = subject
+        self.body      = body
+        self.boundary  = '===============%s==' % uuid.uuid4().hex
+        self.files     = [ ]
+
+    def attach(self, filename, content_type = None):
+        """
+        Attach a file, which is opened now but not read until the message
+        is sent. The MIME type is guessed from the name if not given.
+        Returns False if the file can't be opened.
+        """
+        try:
+            f = open(filename, 'rb')
+        except IOError as e:
+            print e
+            print 'failed to attach', filename
+            return False
+
+        if content_type:
+            maintype, subtype = content_type.split('/', 1)
+        else:
+            maintype, subtype = attachment_type(filename)
+        self.files.append((f, os.path.basename(filename), maintype,
+                           subtype))
+        return True
+
+    def lines(self):
+        """
+        Generate the flattened message, a chunk of whole lines at a time.
+        """
+        yield 'Content-Type: multipart/mixed; boundary="%s"\n' % (
+            self.boundary)
+        yield 'MIME-Version: 1.0\n'
+        yield 'subject: %s\n' % Header(self.subject,
+                                        header_name = 'subject').encode()
+        yield 'To: %s\n' % Header(self.to_string, header_name = 'To').encode()
+        yield 'From: %s\n\n' % get_sender()
+        yield 'pymailer message follows\n'
+
+        # the newline before each delimiter belongs to the delimiter (RFC
+        # 2046), so it's written with it rather than after each part.
+        yield '--%s\n' % self.boundary
+        yield MIMEText(self.body).as_string()
+
+        for f, name, maintype, subtype in self.files:
+            yield '\n--%s\n' % self.boundary
+            if 'text' == maintype:
+                cte    = 'quoted-printable'
+                encode = encode_qp
+            else:
+                cte    = 'base64'
+                encode = encode_base64
+            yield part_headers(maintype, subtype, name, cte)
+
+            try:
+                for chunk in encode(f, self.chunk_size):
+                    yield chunk
+            finally:
+                f.close()
+
+        yield '\n--%s--\n' % self.boundary
+
+    def close(self):
+        for f, name, maintype, subtype in self.files:
+            f.close()
+
+
+def part_headers(maintype, subtype, name, cte):
+    """
+        Returns the header block for an attachment named name, letting
+        the email package quote the name or, if it isn't ASCII, encode it
+        as RFC 2231 describes.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    try:
+        name.decode('ascii')
+    except UnicodeDecodeError:
+        name = ('utf-8', '', name)
+
+    part = MIMEBase(maintype, subtype, name = name)
+    del part['MIME-Version']
+    part['Content-Transfer-Encoding'] = cte
+    part.add_header('Content-Disposition', 'attachment', filename = name)
+    return ''.join('%s: %s\n' % item for item in part.items()) + '\n'
+
+
+def build_streaming(to_list, subject = "", body = "", file_list = []):
+    """
+        Like build_message, but returns a StreamingMessage with the files
+        in file_list attached, for sending with send_stream. Returns
+        False if the message can't be built.
+    """
+    if not to_list:
+        return False
+
+    if not subject and not body:
+        return False
+
+    to_string = check_tolist(to_list)
+    if subject:
+        subject = sanitize(subject)
+
+    mail = StreamingMessage(to_string, subject, body)
+    for file in file_list:
+        mail.attach(file)
+    return mail
+
+
+def send_stream(mail, to_list):
+    """
+        Send a StreamingMessage. Returns True or False, like send.
+    """
+    try:
+        get_transport().sendstream(get_sender(), to_list, mail.lines())
+    except (smtplib.SMTPException, IOError) as e:
+        print e
+        return False
+    else:
+        return True
+    finally:
+        mail.close()
+
+class Throttle:
+    """
+    Spaces out calls to wait() so that, across all threads, they happen
+    at no more than rate per second.
+    """
+    interval = None
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.__lock   = threading.Lock()
+        self.__next   = time.time()
+
+    def wait(self):
+        with self.__lock:
+            now  = time.time()
+            slot = max(now, self.__next)
+            self.__next = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def prepare(message):
+    """
+    Turn a send_bulk message into a tuple of the recipient list and the
+    flattened message, or None if the message can't be built.
+    """
+    if 2 == len(message):
+        to_list, mail = message
+    else:
+        to_list, subject, body = message
+        mail = build_message(to_list, subject, body)
+
+    if not mail or not to_list:
+        return None
+    if not isinstance(mail, basestring):
+        mail = mail.as_string()
+    return to_list, mail
+
+
+def send_bulk(messages, workers = 4, rate = None, callback = None):
+    """
+        send_bulk(messages, workers = 4, rate = None, callback = None)
+
+        Deliver many messages across workers threads, each holding its own
+        persistent SMTP session. messages may be any iterable (including a
+        generator) of (to_list, subject, body) tuples, or of (to_list,
+        message) tuples for messages already built; it is consumed as the
+        workers need more, so it is never held in memory all at once.
+
+        If rate is given, no more than rate messages per second are sent.
+        If callback is given it is called from the worker threads as
+        callback(index, status, detail) for each message, where detail is
+        the exception raised or the dictionary of refused recipients.
+
+        Returns a list of True or False for each message, in input order.
+    """
+    pending  = Queue.Queue(workers * 4)
+    statuses = [ ]
+    lock     = threading.Lock()
+    throttle = None
+    if rate:
+        throttle = Throttle(rate)
+
+    def report(index, status, detail):
+        with lock:
+            statuses[index] = status
+        if not callback:
+            return
+        try:
+            callback(index, status, detail)
+        except Exception as e:
+            sys.stderr.write('!! mailer: send_bulk callback failed: '
+                             + str(e) + '\n')
+
+    def work():
+        pool = get_transport().clone(max_size = 1)
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    return
+
+                index, message = item
+                try:
+                    message = prepare(message)
+                    if not message:
+                        report(index, False, None)
+                        continue
+                    if throttle:
+                        throttle.wait()
+                    refused = pool.sendmail(get_sender(), message[0],
+                                            message[1])
+                except Exception as e:
+                    # one bad message mustn't take the worker down, or
+                    # the producer blocks on the full queue for good.
+                    report(index, False, e)
+                else:
+                    report(index, True, refused)
+        finally:
+            pool.close()
+
+    threads = [ threading.Thread(target = work) for i in range(workers) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for index, message in enumerate(messages):
+            with lock:
+                statuses.append(False)
+            pending.put((index, message))
+    finally:
+        for thread in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+
+    return statuses
+
+
+class Template:
+    """
+    Precompiled mail-merge template. subject and body are string.Template
+    strings (i.e. 'Hello $name'); the sender is captured and the MIME
+    structure around the body is built once, when the template is
+    created, so rendering a message only substitutes the fields and
+    validates the recipients.
+    """
+    subject  = None
+    body     = None
+    sender   = None
+    boundary = None
+
+    def __init__(self, subject = "", body = ""):
+        self.subject  = string.Template(sanitize(subject))
+        self.body     = string.Template(body)
+        self.sender   = get_sender()
+        self.boundary = '===============%s==' % uuid.uuid4().hex
+
+        self.__head = ('Content-Type: multipart/mixed; boundary="%s"\n'
+                       'MIME-Version: 1.0\n' % self.boundary)
+        self.__from = 'From: %s\n\npymailer message follows\n' % self.sender
+        self.__text = ('--%s\n'
+                       'Content-Type: text/plain; charset="us-ascii"\n'
+                       'MIME-Version: 1.0\n'
+                       'Content-Transfer-Encoding: 7bit\n\n' % self.boundary)
+        self.__utf8 = ('--%s\n'
+                       'Content-Type: text/plain; charset="utf-8"\n'
+                       'MIME-Version: 1.0\n'
+                       'Content-Transfer-Encoding: base64\n\n' % self.boundary)
+        self.__tail = '\n--%s--\n' % self.boundary
+
+    def render(self, to_list, fields):
+        """
+        Render the message for one set of recipients, substituting the
+        dictionary fields into the subject and body. Returns a tuple of
+        the accepted recipients and the flattened message, or None if no
+        recipient is valid. A missing field raises KeyError.
+        """
+        to_string, accepted, rejects = validate_addresses(to_list)
+        for index, address in rejects:
+            sys.stderr.write('!! mailer: bad address ' + address + '\n')
+        if not accepted:
+            return None
+
+        subject = sanitize(self.subject.substitute(fields))
+        body    = self.body.substitute(fields)
+        if isinstance(body, unicode):
+            part = self.__utf8
+            body = base64.encodestring(body.encode('utf-8'))
+        else:
+            part = self.__text
+
+        return accepted, ''.join([ self.__head,
+                                   fold('subject', subject),
+                                   fold('To', to_string),
+                                   self.__from, part, body, self.__tail ])
+
+    def messages(self, recipients):
+        """
+        Render a message for each (to_list, fields) pair in recipients, in
+        the form send_bulk takes. Messages that can't be rendered are
+        passed on as empty, so send_bulk reports them as failed.
+        """
+        for to_list, fields in recipients:
+            try:
+                rendered = self.render(to_list, fields)
+            except (KeyError, ValueError) as e:
+                sys.stderr.write('!! mailer: bad template field %s\n' % e)
+                rendered = None
+
+            if not rendered:
+                yield to_list, None
+            else:
+                yield rendered
+
+
+def fold(name, value):
+    """
+    Format a header line, folding and encoding it only if it needs it.
+    """
+    if len(name) + len(value) < 76 and not isinstance(value, unicode):
+        return '%s: %s\n' % (name, value)
+    return '%s: %s\n' % (name, Header(value, header_name = name).encode())
+
+
+def merge(template, recipients, workers = 4, rate = None, callback = None):
+    """
+        merge(template, recipients, workers = 4, rate = None, callback = None)
+
+        Send a personalised copy of template (a Template) for each
+        (to_list, fields) pair in recipients, through send_bulk. Returns
+        send_bulk's list of statuses.
+    """
+    return send_bulk(template.messages(recipients), workers, rate, callback)
+
+
+def permanent_failure(error):
+    """
+        Returns True if a failed delivery shouldn't be retried: the
+        server refused every recipient, the sender or the message itself
+        with a 5xx reply. Anything else, including 4xx replies and lost
+        connections, is worth trying again.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, resp in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return error.smtp_code >= 500
+    return False
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool:
+    """
+    Crash-safe outbound mail queue, kept as a maildir-style spool
+    directory with tmp/, new/ and failed/ subdirectories. put() writes a
+    message to tmp/ and returns at once; a background thread fsyncs
+    newly written messages in batches, moves them into new/, and delivers
+    them through the current transport. A message that can't be
+    delivered is retried with exponential backoff, and moved to failed/
+    after max_attempts, or at once if the server rejected it outright. The attempt count and next retry time are kept
+    in the message's file name, so the spool picks up where it left off
+    after a restart.
+    """
+    path           = None
+    batch_interval = None
+    backoff        = None
+    max_backoff    = None
+    max_attempts   = None
+
+    def __init__(self, path, batch_interval = 0.05, backoff = 30,
+                 max_backoff = 3600, max_attempts = 10):
+        self.path           = path
+        self.batch_interval = batch_interval
+        self.backoff        = backoff
+        self.max_backoff    = max_backoff
+        self.max_attempts   = max_attempts
+        self.__lock         = threading.Condition()
+        self.__uncommitted  = [ ]
+        self.__seq          = 0
+        self.__running      = False
+        self.__thread       = None
+        self.__host         = socket.gethostname().replace('/', '_')
+
+        for subdir in ('tmp', 'new', 'failed'):
+            if not os.path.isdir(os.path.join(path, subdir)):
+                os.makedirs(os.path.join(path, subdir))
+        self.__recover__()
+
+    def __recover__(self):
+        # anything left in tmp/ was never committed; keep it if it was
+        # written out in full, otherwise it's unrecoverable.
+        tmp = os.path.join(self.path, 'tmp')
+        for name in os.listdir(tmp):
+            if self.read(os.path.join(tmp, name)):
+                self.__uncommitted.append(name)
+            else:
+                sys.stderr.write('!! mailer: dropping partial spool file '
+                                 + name + '\n')
+                os.unlink(os.path.join(tmp, name))
+        self.commit()
+
+    def put(self, from_addr, to_list, message):
+        """
+        Add a message to the spool, returning its name. The message is
+        written but not yet synced to disk.
+        """
+        header = json.dumps({ 'from': from_addr, 'to': list(to_list),
+                              'length': len(message) })
+        with self.__lock:
+            self.__seq += 1
+            name = '%d.%d_%d.%s' % (time.time(), os.getpid(), self.__seq,
+                                    self.__host)
+
+        f = open(os.path.join(self.path, 'tmp', name), 'wb')
+        try:
+            f.write(header + '\n' + message)
+        finally:
+            f.close()
+
+        with self.__lock:
+            self.__uncommitted.append(name)
+            self.__lock.notify()
+        return name
+
+    def read(self, filename):
+        """
+        Read a spooled message, returning (from_addr, to_list, message),
+        or None if the file is incomplete or unreadable.
+        """
+        try:
+            f = open(filename, 'rb')
+            try:
+                header  = json.loads(f.readline())
+                message = f.read()
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+        if len(message) != header.get('length'):
+            return None
+        return header['from'], header['to'], message
+
+    def commit(self):
+        """
+        Sync every message written since the last commit and move them
+        into new/, returning the number committed.
+        """
+        with self.__lock:
+            names = self.__uncommitted
+            self.__uncommitted = [ ]
+        if not names:
+            return 0
+
+        tmp = os.path.join(self.path, 'tmp')
+        new = os.path.join(self.path, 'new')
+        for name in names:
+            fd = os.open(os.path.join(tmp, name), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(os.path.join(tmp, name),
+                      os.path.join(new, name + ':0:0'))
+        fsync_dir(new)
+        fsync_dir(tmp)
+        return len(names)
+
+    def due(self, now = None):
+        """
+        Return the names of messages in new/ that are due to be sent,
+        oldest first.
+        """
+        if now is None:
+            now = time.time()
+
+        names = [ ]
+        for name in os.listdir(os.path.join(self.path, 'new')):
+            base, attempts, next_try = name.rsplit(':', 2)
+            if int(next_try) <= now:
+                names.append(name)
+        names.sort()
+        return names
+
+    def defer(self, name):
+        """
+        Reschedule a message after a failed delivery, or move it to
+        failed/ once it has run out of attempts.
+        """
+        base, attempts, next_try = name.rsplit(':', 2)
+        attempts = int(attempts) + 1
+        source   = os.path.join(self.path, 'new', name)
+
+        if attempts >= self.max_attempts:
+            self.fail(name)
+            return
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        os.rename(source, os.path.join(self.path, 'new', '%s:%d:%d' % (
+                  base, attempts, time.time() + delay)))
+
+    def fail(self, name):
+        """
+        Give up on a message, moving it to failed/.
+        """
+        base, attempts, next_try = name.rsplit(':', 2)
+        os.rename(os.path.join(self.path, 'new', name),
+                  os.path.join(self.path, 'failed', base))
+
+    def deliver(self):
+        """
+        Commit new messages and try to send every message that is due.
+        Returns the number of messages sent.
+        """
+        self.commit()
+
+        sent = 0
+        for name in self.due():
+            filename = os.path.join(self.path, 'new', name)
+            message  = self.read(filename)
+            if not message:
+                sys.stderr.write('!! mailer: unreadable spool file '
+                                 + name + '\n')
+                self.defer(name)
+                continue
+
+            try:
+                get_transport().sendmail(*message)
+            except (smtplib.SMTPException, IOError) as e:
+                if permanent_failure(e):
+                    sys.stderr.write('!! mailer: failed %s: %s\n' % (name, e))
+                    self.fail(name)
+                    continue
+                sys.stderr.write('!! mailer: deferring %s: %s\n' % (name, e))
+                self.defer(name)
+            else:
+                os.unlink(filename)
+                sent += 1
+        return sent
+
+    def pending(self):
+        """
+        Return the number of messages waiting to be sent.
+        """
+        with self.__lock:
+            uncommitted = len(self.__uncommitted)
+        return uncommitted + len(os.listdir(os.path.join(self.path, 'new')))
+
+    def start(self):
+        with self.__lock:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread = threading.Thread(target = self.__run__)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the sender thread once it has made a last delivery pass.
+        """
+        with self.__lock:
+            self.__running = False
+            self.__lock.notify()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run__(self):
+        while True:
+            try:
+                self.deliver()
+            except (OSError, IOError) as e:
+                sys.stderr.write('!! mailer: spool error: %s\n' % e)
+
+            with self.__lock:
+                if not self.__running:
+                    return
+                if not self.__uncommitted:
+                    self.__lock.wait(1.0)
+                woken = bool(self.__uncommitted)
+
+            # give other producers a moment so their messages are synced
+            # in the same batch.
+            if woken:
+                time.sleep(self.batch_interval)
+
+
+spool = [ None ]
+
+
+def set_spool(path, **kwargs):
+    """
+        set_spool(path, **kwargs)
+
+        Use path as the on-disk spool for enqueue() and start its
+        background sender; kwargs are passed on to Spool. Any messages
+        left in the spool by a previous run are sent. Returns True.
+    """
+    if spool[0]:
+        spool[0].stop()
+    spool[0] = Spool(path, **kwargs)
+    spool[0].start()
+    return True
+
+
+def get_spool():
+    return spool[0]
+
+
+def enqueue(to_list, subject = "", body = ""):
+    """
+        enqueue(to_list, subject = "", body = "")
+
+        Like simple(), but queues the message in the spool (see
+        set_spool) and returns without waiting for it to be sent.
+        Returns False if the message can't be built or no spool is set.
+    """
+    if not spool[0]:
+        sys.stderr.write('!! mailer: no spool set\n')
+        return False
+
+    mail = build_message(to_list, subject, body)
+    if not mail or not to_list:
+        return False
+
+    spool[0].put(get_sender(), to_list, mail.as_string())
+    return True
+
+
 if __name__ == "__main__":
     # usage:
     # -t <to> add a person to the to-list
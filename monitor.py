@@ -34,12 +34,64 @@ def main(args):
 
 Note that by default, no mode is set. This is to force the developer to
 think about what the proper mode for operation is.
+
+Repeated failures are deduplicated: each exception is fingerprinted by its
+type and the frames it passed through, and an alert goes out for the first
+occurrence of a fingerprint, with repeats held back and summarised in
+periodic digest emails. The policy can be tuned by passing an AlertPolicy
+to initialise().
+
+After a failure the target is restarted according to a RestartPolicy,
+which backs off exponentially and cools down if the target is crash
+looping; restart_stats() reports restart counts and delays. Any object
+with delay(runtime), stats() and clone() methods can be passed to
+initialise() in its place.
+
+supervise() runs the target in a number of forked worker processes
+instead, so that it can use more than one core and a crash or leak in the
+target can't take the monitor down with it. Each worker is restarted on
+its own according to the mode, and its tracebacks are sent back to the
+supervising process to be handled there.
+
+initialise() can also start a small status server, answering GET
+requests with a JSON summary of the monitor: its mode, uptime, restart
+count, the fingerprint of the last failure, and the wall and CPU time of
+the current run of the target (or of each worker's run, when supervised).
+
+A target that can stall rather than fail should call heartbeat() as it
+makes progress and be given a stall deadline by initialise(). If no
+heartbeat arrives within the deadline, the stacks of every thread are
+sent to the handlers, and if stall_restart is set the target is
+restarted: a supervised worker is killed, while an in-process target has
+Stalled raised in it. The latter only takes effect once the target's
+thread next runs Python code, so a thread blocked inside a single C call
+won't be interrupted by it.
+
+A Profiler can be passed to initialise() to sample where the process
+spends its time. It is off until toggled, by default with SIGUSR2, and
+writes its samples as collapsed stacks for flamegraph.pl and friends;
+with a status server running they can also be fetched from /profile.
 """
 
 import mailer as mail
+import BaseHTTPServer
+import SocketServer
+import collections
+import ctypes
 import datetime
+import errno
+import fcntl
+import hashlib
+import json
+import linecache
 import os
+import random
+import repr as reprlib
+import resource
+import select
+import signal
 import sys
+import threading
 import time
 import traceback
 
@@ -49,6 +101,21 @@ GLOBALS = {
     'production': False,
     'staging': False,
     'development': False,
+    'alerts': None,
+    'digester': None,
+    'restart': None,
+    'capture_locals': False,
+    'status': None,
+    'started': time.time(),
+    'run': None,
+    'last_fingerprint': None,
+    'workers': None,
+    'heartbeat': None,
+    'deadline': None,
+    'stall_restart': False,
+    'watchdog': None,
+    'target_lock': threading.Lock(),
+    'profiler': None,
 }
 
 
@@ -123,36 +190,379 @@ def set_development():
 
 class Traceback:
     """
-    Internal traceback class, currently only a very basic file target for
-    the traceback.print_foo() method
+    Record of an exception: its type, the frames it passed through as
+    (filename, lineno, function) tuples, and optionally a capped repr of
+    each frame's locals. Nothing is read from the source files or
+    formatted until the text is asked for with read() (or str()), so a
+    record is cheap enough to take for every failure; file and function
+    names are interned, so records share them.
+
+    exc_info is a tuple as returned by sys.exc_info(). Without one, the
+    record is empty and can still be used as a file for the
+    traceback.print_foo() methods; anything written is returned by read()
+    ahead of the frames.
     """
-    buf = None
+    exc_type = None
+    frames   = None
+    locals   = None
+    summary  = None
 
-    def __init__(self):
+    def __init__(self, exc_info = None, capture_locals = False,
+                 max_locals = 16, max_repr = 128):
         self.clear()
+        if not exc_info or not exc_info[0]:
+            return
+        exc_type, value, tb = exc_info
+
+        frames = [ ]
+        scopes = [ ]
+        while tb is not None:
+            frame = tb.tb_frame
+            code  = frame.f_code
+            frames.append((intern(code.co_filename), tb.tb_lineno,
+                           intern(code.co_name)))
+            if capture_locals:
+                scopes.append(_capture_locals(frame, max_locals, max_repr))
+            tb = tb.tb_next
+
+        self.exc_type = exc_type
+        self.frames   = tuple(frames)
+        self.summary  = traceback.format_exception_only(exc_type, value)
+        if capture_locals:
+            self.locals = tuple(scopes)
 
     def clear(self):
         """
         Wipe the traceback buffer.
         """
-        self.buf = ''
+        self.__buf  = [ ]
+        self.__text = None
 
     def write(self, buf):
         """
         Append more data to the traceback buffer.
         """
-        self.buf += buf
+        self.__buf.append(buf)
+        self.__text = None
 
     def read(self):
         """
-        Read out the buffer.
+        Format the traceback, in the same form as traceback.print_exc().
+        The text is kept once it has been formatted.
         """
-        return self.buf
+        if self.__text is not None:
+            return self.__text
 
+        lines = list(self.__buf)
+        if self.frames:
+            lines.append('Traceback (most recent call last):\n')
+            for i in range(len(self.frames)):
+                filename, lineno, name = self.frames[i]
+                lines.append('  File "%s", line %d, in %s\n' % (
+                             filename, lineno, name))
+                line = linecache.getline(filename, lineno).strip()
+                if line:
+                    lines.append('    %s\n' % line)
+                if self.locals and self.locals[i]:
+                    for var, value in self.locals[i]:
+                        lines.append('      %s = %s\n' % (var, value))
+        if self.summary:
+            lines.extend(self.summary)
 
-def monitor(target, **kwargs):
+        self.__text = ''.join(lines)
+        return self.__text
+
+    def __str__(self):
+        return self.read()
+
+    def fingerprint(self):
+        """
+        Identify the failure by its exception type and the code locations
+        in its traceback, ignoring the exception's message and local state.
+        """
+        if not self.exc_type:
+            return None
+        return _locations_fingerprint(self.exc_type.__name__, self.frames)
+
+
+def _locations_fingerprint(name, frames):
+    locations = [ '%s:%d:%s' % frame for frame in frames ]
+    key = '%s|%s' % (name, '|'.join(locations))
+    return hashlib.sha1(key).hexdigest()[:16]
+
+
+class _LocalsRepr(reprlib.Repr):
     """
-    Primary monitor function to ensure proper error handling.
+    reprlib.Repr, which only renders as much of a string or container as
+    it will show, extended to unicode strings.
+    """
+    repr_unicode = reprlib.Repr.repr_str
+
+    def __init__(self, max_repr):
+        reprlib.Repr.__init__(self)
+        self.maxstring    = self.maxlong = self.maxother = max_repr
+        self.maxlist      = self.maxtuple = self.maxset = 8
+        self.maxfrozenset = self.maxdeque = self.maxarray = 8
+        self.maxdict      = 4
+        self.maxlevel     = 3
+
+
+def _capture_locals(frame, max_locals, max_repr):
+    """
+    Return up to max_locals of a frame's local variables, as a tuple of
+    (name, repr) pairs with each repr cut to max_repr characters. Large
+    strings and containers are only partly rendered.
+    """
+    scope   = [ ]
+    shorten = _LocalsRepr(max_repr)
+    for var in sorted(frame.f_locals.keys())[:max_locals]:
+        try:
+            value = shorten.repr(frame.f_locals[var])
+        except Exception:
+            value = '<unrepresentable>'
+        if len(value) > max_repr:
+            value = value[:max_repr] + '...'
+        scope.append((intern(str(var)), value))
+    return tuple(scope)
+
+
+def fingerprint(exc_type, tb):
+    """
+    Identify a failure by its exception type and the code locations in
+    its traceback, ignoring the exception's message and local state.
+    """
+    return Traceback((exc_type, None, tb)).fingerprint()
+
+
+class AlertPolicy:
+    """
+    Decides which failures are worth an alert email. The first occurrence
+    of a fingerprint is always alerted on; repeats within interval seconds
+    are held back, as is anything over max_alerts alerts in any interval.
+    Held back failures are counted and sent as a digest every
+    digest_interval seconds, with the first max_stack bytes of a sample
+    stack. At most max_fingerprints fingerprints are tracked (the least
+    recently seen are dropped), so memory use is bounded however many
+    failures there are.
+    """
+    interval         = None
+    max_alerts       = None
+    digest_interval  = None
+    max_fingerprints = None
+    max_stack        = None
+
+    def __init__(self, interval = 3600, max_alerts = 10,
+                 digest_interval = 900, max_fingerprints = 256,
+                 max_stack = 16384):
+        self.interval         = interval
+        self.max_alerts       = max_alerts
+        self.digest_interval  = digest_interval
+        self.max_fingerprints = max_fingerprints
+        self.max_stack        = max_stack
+        self.__lock           = threading.Lock()
+        self.__seen           = collections.OrderedDict()
+        self.__sent           = collections.deque()
+        self.__last_digest    = time.time()
+
+    def record(self, fp, summary, stack = None, now = None):
+        """
+        Record a failure, returning True if an alert should go out for it.
+        stack, either text or a Traceback, is only kept for the first
+        occurrence of a fingerprint.
+        """
+        if now is None:
+            now = time.time()
+
+        with self.__lock:
+            entry = self.__seen.pop(fp, None)
+            if not entry:
+                entry = { 'summary': summary, 'stack': stack, 'count': 0,
+                          'first': now, 'last': now, 'alerted': None,
+                          'held': 0 }
+            self.__seen[fp] = entry
+            while len(self.__seen) > self.max_fingerprints:
+                self.__seen.popitem(last = False)
+
+            entry['count'] += 1
+            entry['last']   = now
+
+            while self.__sent and self.__sent[0] <= now - self.interval:
+                self.__sent.popleft()
+
+            repeat = entry['alerted'] and now - entry['alerted'] < self.interval
+            if repeat or len(self.__sent) >= self.max_alerts:
+                entry['held'] += 1
+                return False
+
+            entry['alerted'] = now
+            self.__sent.append(now)
+            return True
+
+    def digest(self, now = None, force = False):
+        """
+        If a digest is due (or force is set) and failures have been held
+        back since the last one, return the digest text and reset the
+        held counts. Otherwise returns None.
+        """
+        if now is None:
+            now = time.time()
+
+        with self.__lock:
+            if not force and now - self.__last_digest < self.digest_interval:
+                return None
+            self.__last_digest = now
+
+            held = [ (fp, entry) for fp, entry in self.__seen.items()
+                     if entry['held'] ]
+            if not held:
+                return None
+
+            lines = [ ]
+            for fp, entry in held:
+                lines.append('%s: %s\n'
+                             '    %d held back, %d in total\n'
+                             '    first seen %s, last seen %s\n' % (
+                             fp, entry['summary'], entry['held'],
+                             entry['count'],
+                             datetime.datetime.utcfromtimestamp(entry['first']),
+                             datetime.datetime.utcfromtimestamp(entry['last'])))
+                if entry['stack']:
+                    lines.append(str(entry['stack'])[:self.max_stack] + '\n')
+                entry['held'] = 0
+
+        return '\n'.join(lines)
+
+
+class RestartPolicy:
+    """
+    Decides how long to wait before restarting a failed target. Waits
+    grow exponentially from backoff up to max_backoff, with equal jitter
+    (so successive waits never collapse back to zero). If the target fails
+    more than max_restarts times within window seconds, it is crash
+    looping, and the next wait is a cool-down of cooldown seconds instead.
+    A run lasting at least healthy seconds resets the backoff.
+    """
+    backoff      = None
+    max_backoff  = None
+    jitter       = None
+    max_restarts = None
+    window       = None
+    cooldown     = None
+    healthy      = None
+
+    def __init__(self, backoff = 1, max_backoff = 300, jitter = True,
+                 max_restarts = 10, window = 600, cooldown = 900,
+                 healthy = 300):
+        self.backoff      = backoff
+        self.max_backoff  = max_backoff
+        self.jitter       = jitter
+        self.max_restarts = max_restarts
+        self.window       = window
+        self.cooldown     = cooldown
+        self.healthy      = healthy
+        self.__lock       = threading.Lock()
+        self.__recent     = collections.deque()
+        self.__failures   = 0
+        self.__stats      = { 'state': 'running', 'restarts': 0,
+                              'cooldowns': 0, 'last_delay': 0.0,
+                              'total_delay': 0.0, 'last_runtime': None,
+                              'last_restart': None }
+
+    def delay(self, runtime, now = None):
+        """
+        Record a failure after the target ran for runtime seconds, and
+        return the number of seconds to wait before restarting it.
+        """
+        if now is None:
+            now = time.time()
+
+        with self.__lock:
+            if runtime >= self.healthy:
+                self.__failures = 0
+
+            self.__recent.append(now)
+            while self.__recent and self.__recent[0] <= now - self.window:
+                self.__recent.popleft()
+
+            if len(self.__recent) > self.max_restarts:
+                delay = self.cooldown
+                state = 'cooldown'
+                self.__recent.clear()
+                self.__stats['cooldowns'] += 1
+            else:
+                delay = min(self.max_backoff,
+                            self.backoff * (2 ** self.__failures))
+                if self.jitter:
+                    delay = random.uniform(delay / 2.0, delay)
+                state = 'backoff'
+            self.__failures += 1
+
+            self.__stats['state']         = state
+            self.__stats['restarts']     += 1
+            self.__stats['last_delay']    = delay
+            self.__stats['total_delay']  += delay
+            self.__stats['last_runtime']  = runtime
+            self.__stats['last_restart']  = now + delay
+            return delay
+
+    def clone(self):
+        """
+        Return a new policy with the same settings and no history, for
+        tracking another worker's restarts.
+        """
+        return RestartPolicy(self.backoff, self.max_backoff, self.jitter,
+                             self.max_restarts, self.window, self.cooldown,
+                             self.healthy)
+
+    def stats(self):
+        """
+        Return the restart metrics: the current state ('running',
+        'backoff' or 'cooldown'), the number of restarts and cool-downs,
+        the last and total seconds spent waiting, how long the last failed
+        run lasted and when the target was (or will be) last restarted.
+        """
+        with self.__lock:
+            stats = dict(self.__stats)
+        if stats['last_restart'] and stats['last_restart'] <= time.time():
+            stats['state'] = 'running'
+        return stats
+
+
+def restart_stats():
+    """
+    Return the restart policy's metrics, or None if the monitor hasn't
+    been started.
+    """
+    if not GLOBALS['restart']:
+        return None
+    return GLOBALS['restart'].stats()
+
+
+def _digest_loop():
+    """
+    Background thread sending alert digests as they fall due.
+    """
+    while True:
+        policy = GLOBALS['alerts']
+        time.sleep(min(60, policy.digest_interval))
+        _send_digest()
+
+
+def _send_digest(force = False):
+    digest = GLOBALS['alerts'].digest(force = force)
+    if not digest:
+        return
+
+    subject = 'failure digest for %s (pid %d)' % (sys.argv[0], os.getpid())
+    body = 'repeated failures held back since the last alert:\n\n%s' % (
+        digest)
+    _send_alert(subject, body)
+
+
+def _setup():
+    """
+    Check the monitor has been initialised and fill in the default
+    policies.
     """
     if not GLOBALS['devs'] or not GLOBALS['sender']:
         raise Exception("need to initialise devs and sender!")
@@ -162,36 +572,895 @@ def monitor(target, **kwargs):
         raise Exception("no mode selected.")
 
     mail.set_sender(GLOBALS['sender'])
+    if not GLOBALS['alerts']:
+        GLOBALS['alerts'] = AlertPolicy()
+    if not GLOBALS['restart']:
+        GLOBALS['restart'] = RestartPolicy()
+
+    if not GLOBALS['digester']:
+        GLOBALS['digester'] = threading.Thread(target = _digest_loop)
+        GLOBALS['digester'].daemon = True
+        GLOBALS['digester'].start()
+
+
+def monitor(target, **kwargs):
+    """
+    Primary monitor function to ensure proper error handling.
+    """
+    _setup()
+    ident = threading.current_thread().ident
+    _start_watchdog(_stalled_in_process(ident))
 
     while True:
+        started = time.time()
+        GLOBALS['run'] = (started, _cpu_time())
+        GLOBALS['heartbeat'] = started
+        failure = None
         try:
-            # should we pass args in or not?
-            if not kwargs == None:
-                target(**kwargs)
-            else:
-                target()
+            try:
+                # should we pass args in or not?
+                if not kwargs == None:
+                    target(**kwargs)
+                else:
+                    target()
+            finally:
+                _target_done(ident)
         except KeyboardInterrupt:       # die on ^C - for attached processes
+            _target_done(ident)
+            _send_digest(force=True)
             return
+        except Stalled as error:        # not caught by the target's own
+            failure = error             # except Exception handlers
         except Exception as error:
-            stack = _dump_traceback(error)[0]
+            failure = error
+
+        # a Stalled arriving in the finally above can cut it short
+        _target_done(ident)
+        if failure is None:
+            continue
+
+        try:
+            # a stall has already been reported by the watchdog
+            if not isinstance(failure, Stalled):
+                stack = _dump_traceback(failure)[0]
+                _handle_failure(stack, failure, stack.fingerprint())
+
+            _restart_wait(time.time() - started)
+        except Stalled:
+            pass
+        except KeyboardInterrupt:
+            _send_digest(force=True)
+            return
+
+
+def _target_done(ident):
+    """
+    Mark the in-process target as no longer running, so the watchdog
+    won't restart it, and cancel any Stalled it has already been sent
+    but which hasn't been raised yet.
+    """
+    while True:
+        try:
+            with GLOBALS['target_lock']:
+                GLOBALS['heartbeat'] = None
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_long(ident), None)
+            return
+        except Stalled:
+            continue
+
+
+def _handle_failure(stack, error, fp, fatal=True):
+    """
+    Pass a failure to the handlers for the current mode. A failure that
+    isn't fatal (a stall the target may yet recover from) is never
+    raised, even in development mode.
+    """
+    GLOBALS['last_fingerprint'] = fp
+    if not fatal:
+        if development_p() or staging_p():
+            print stack
+        if production_p() or staging_p():
+            _handle_production(stack, error, fp)
+        return
+
+    if development_p():
+        _handle_development(stack, error)
+    if staging_p():
+        _handle_staging(stack, error, fp)
+    if production_p():
+        _handle_production(stack, error, fp)
+
+
+class Stalled(BaseException):
+    """
+    Raised in a target that has missed its heartbeat deadline, to restart
+    it. Like KeyboardInterrupt it isn't an Exception, so a target's own
+    except Exception handlers won't swallow it.
+    """
+
+
+def heartbeat():
+    """
+    Tell the watchdog the target is still making progress.
+    """
+    GLOBALS['heartbeat'] = time.time()
+
+
+def thread_stacks(target = None):
+    """
+    Format the current stack of every thread but the caller's. Returns
+    the text and a fingerprint of the target thread's stack (by thread
+    ident), or None if there is no target.
+    """
+    names  = dict([ (thread.ident, thread.name)
+                    for thread in threading.enumerate() ])
+    me     = threading.current_thread().ident
+    lines  = [ ]
+    fp     = None
+    for ident, frame in sys._current_frames().items():
+        if ident == me:
+            continue
+        lines.append('Thread %s (%d)%s:\n' % (names.get(ident, '?'), ident,
+                     ident == target and ' [target]' or ''))
+        lines.extend(traceback.format_stack(frame))
+        lines.append('\n')
+        if ident == target:
+            frames = [ ]
+            while frame is not None:
+                frames.append((frame.f_code.co_filename, frame.f_lineno,
+                               frame.f_code.co_name))
+                frame = frame.f_back
+            fp = _locations_fingerprint('Stalled', reversed(frames))
+        del frame
+    return ''.join(lines), fp
+
+
+def _start_watchdog(report):
+    """
+    Start the watchdog thread if a stall deadline has been set. report is
+    called with a Stalled error and the time of the missed heartbeat when
+    the deadline is missed.
+    """
+    if not GLOBALS['deadline'] or GLOBALS['watchdog']:
+        return
+    GLOBALS['watchdog'] = threading.Thread(target = _watchdog,
+                                           args = (report, ))
+    GLOBALS['watchdog'].daemon = True
+    GLOBALS['watchdog'].start()
+
+
+def _watchdog(report):
+    """
+    Watchdog thread: checks the heartbeat a few times per deadline, and
+    reports a stall once, until the next heartbeat.
+    """
+    fired = None
+    while True:
+        deadline = GLOBALS['deadline']
+        time.sleep(min(1.0, deadline / 4.0))
+        last = GLOBALS['heartbeat']
+        if last is None or last == fired or time.time() - last < deadline:
+            continue
+
+        fired = last
+        error = Stalled('no heartbeat for %.1fs' % (time.time() - last))
+        report(error, last)
+
+
+def _stalled_in_process(ident):
+    """
+    Report a stall of the in-process target running in thread ident,
+    restarting it if asked to. Stalled is only sent while the run that
+    missed its heartbeat (last) is still going.
+    """
+    def report(error, last):
+        stack, fp = thread_stacks(ident)
+        stack = 'target stalled: %s\n\n%s' % (error, stack)
+        _handle_failure(stack, error, fp, fatal=False)
+        if not GLOBALS['stall_restart']:
+            return
+        with GLOBALS['target_lock']:
+            if GLOBALS['heartbeat'] == last:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_long(ident), ctypes.py_object(Stalled))
+    return report
+
+
+class Profiler:
+    """
+    Statistical profiler. While running, a timer thread samples the
+    stack of every other thread each interval seconds and counts how
+    often each stack is seen; the counts are written out as collapsed
+    stacks (one 'thread;outer;...;inner count' line per stack), which
+    flamegraph.pl and most flame graph viewers read directly.
+
+    Memory is bounded: stacks are cut to their innermost max_depth
+    frames, and once max_stacks distinct stacks have been seen, samples
+    of new ones are only counted as [other]. If output is set, samples
+    are written there when the profiler is stopped and, if dump_interval
+    is set, every dump_interval seconds while it runs; output may contain
+    %(pid)d so that supervised workers each write their own file.
+
+    At the default of 100 samples a second, sampling costs around 1% of
+    one core on a process with a handful of threads; stats() reports the
+    measured cost.
+    """
+    interval      = None
+    max_stacks    = None
+    max_depth     = None
+    output        = None
+    dump_interval = None
+    signum        = None
+
+    def __init__(self, interval = 0.01, max_stacks = 10000, max_depth = 64,
+                 output = None, dump_interval = None,
+                 signum = signal.SIGUSR2):
+        self.interval      = interval
+        self.max_stacks    = max_stacks
+        self.max_depth     = max_depth
+        self.output        = output
+        self.dump_interval = dump_interval
+        self.signum        = signum
+        self.__lock        = threading.Lock()
+        self.__thread      = None
+        self.__running     = False
+        self.__names       = { }
+        self.__labels      = { }
+        self.clear()
+
+    def clear(self):
+        """
+        Throw away the samples collected so far.
+        """
+        with self.__lock:
+            self.__counts   = { }
+            self.__other    = 0
+            self.__samples  = 0
+            self.__cost     = 0.0
+            self.__wall     = 0.0
+
+    def running(self):
+        return bool(self.__thread and self.__thread.is_alive() and
+                    self.__running)
+
+    def start(self):
+        if self.running():
+            return
+        self.__running = True
+        self.__thread  = threading.Thread(target = self.__run__)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop sampling, writing the samples to output if it is set.
+        """
+        if not self.running():
+            return
+        self.__running = False
+        if self.__thread is not threading.current_thread():
+            self.__thread.join()
+        if self.output:
+            self.write()
+
+    def toggle(self, *args):
+        """
+        Start the profiler if it is stopped and stop it if it is running;
+        also usable as a signal handler.
+        """
+        if self.running():
+            self.stop()
+        else:
+            self.start()
+
+    def install(self):
+        """
+        Make signum toggle the profiler. Must be called from the main
+        thread.
+        """
+        if self.signum:
+            signal.signal(self.signum, self.toggle)
+
+    def __run__(self):
+        started   = time.time()
+        next_dump = started + (self.dump_interval or 0)
+        while self.__running:
+            self.sample()
+            now = time.time()
+            with self.__lock:
+                self.__wall += now - started
+            started = now
+            if self.dump_interval and self.output and now >= next_dump:
+                self.write()
+                next_dump = now + self.dump_interval
+            time.sleep(self.interval)
+
+    def sample(self):
+        """
+        Take one sample of every thread's stack but the caller's.
+        """
+        start  = time.time()
+        me     = threading.current_thread().ident
+        frames = sys._current_frames()
+        frame  = None
+
+        stacks = [ ]
+        for ident, frame in frames.items():
+            if ident == me:
+                continue
+            if ident not in self.__names:
+                self.__names = dict([ (thread.ident, thread.name)
+                                      for thread in threading.enumerate() ])
+            codes = [ ]
+            while frame is not None and len(codes) < self.max_depth:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            stacks.append((self.__names.get(ident, '?'), frame is not None,
+                           tuple(codes)))
+        del frames, frame
+
+        with self.__lock:
+            for key in stacks:
+                if key in self.__counts:
+                    self.__counts[key] += 1
+                elif len(self.__counts) < self.max_stacks:
+                    self.__counts[key] = 1
+                else:
+                    self.__other += 1
+            self.__samples += 1
+            self.__cost    += time.time() - start
+
+    def __label__(self, code):
+        label = self.__labels.get(code)
+        if not label:
+            label = '%s (%s:%d)' % (code.co_name, code.co_filename,
+                                    code.co_firstlineno)
+            label = label.replace(';', ':')
+            self.__labels[code] = label
+        return label
+
+    def collapsed(self):
+        """
+        Return the samples as collapsed stacks, outermost frame first.
+        """
+        with self.__lock:
+            counts = self.__counts.items()
+            other  = self.__other
+
+        lines = [ ]
+        for (name, truncated, codes), count in counts:
+            parts = [ name.replace(';', ':').replace(' ', '_') ]
+            if truncated:
+                parts.append('[truncated]')
+            parts.extend([ self.__label__(code) for code in reversed(codes) ])
+            lines.append('%s %d' % (';'.join(parts), count))
+        if other:
+            lines.append('[other] %d' % other)
+        lines.sort()
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path = None):
+        """
+        Write the collapsed stacks to path (by default, output), replacing
+        it atomically.
+        """
+        path = (path or self.output) % { 'pid': os.getpid() }
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'w') as out:
+            out.write(self.collapsed())
+        os.rename(temp, path)
+
+    def stats(self):
+        """
+        Return the number of samples and distinct stacks collected, and
+        the fraction of the time spent running that went on sampling.
+        """
+        with self.__lock:
+            return { 'running': self.running(),
+                     'samples': self.__samples,
+                     'stacks': len(self.__counts),
+                     'other': self.__other,
+                     'overhead': self.__wall and self.__cost / self.__wall }
+
+
+def _restart_wait(runtime):
+    """
+    Wait out the restart policy's delay before the target is restarted.
+    """
+    time.sleep(_restart_delay(GLOBALS['restart'], runtime, sys.argv[0]))
+
+
+def _restart_delay(policy, runtime, name):
+    """
+    Ask policy how long to wait before restarting, alerting if it has
+    gone into cool-down.
+    """
+    delay = policy.delay(runtime)
+    stats = policy.stats()
+    if 'cooldown' == stats.get('state'):
+        sys.stderr.write('!! monitor: %s is crash looping; cooling down '
+                         'for %.1fs\n' % (name, delay))
+        if production_p() or staging_p():
+            subject = 'crash loop in %s (pid %d)' % (name, os.getpid())
+            body = ('%d restarts so far; the next restart is in %.1f seconds.'
+                    '\n' % (stats['restarts'], delay))
+            _send_alert(subject, body)
+    return delay
+
+
+class WorkerFailure(Exception):
+    """
+    A failure in a supervised worker process, either an exception raised
+    by the target (whose traceback is in stack) or the worker dying.
+    """
+    worker = None
+    pid    = None
+    stack  = None
+
+    def __init__(self, worker, pid, summary, stack):
+        Exception.__init__(self, 'worker %d (pid %d): %s' % (worker, pid,
+                                                             summary))
+        self.worker = worker
+        self.pid    = pid
+        self.stack  = stack
+
+
+class Worker:
+    """
+    A supervised worker process running the target. Failures are written
+    back to the supervisor over a pipe, one line of JSON each; a fatal
+    one is the last thing the worker sends before exiting.
+    """
+    slot       = None
+    pid        = None
+    fd         = None
+    started    = None
+    restart_at = None
+    policy     = None
+    killed     = None                   # why the supervisor killed it
+    reported   = None                   # whether it sent a fatal failure
+
+    def __init__(self, slot, policy):
+        self.slot       = slot
+        self.policy     = policy
+        self.restart_at = 0
+        self.__buf      = ''
+
+    def start(self, target, kwargs, limits, others):
+        rfd, wfd = os.pipe()
+        for fd in (rfd, wfd):
+            _cloexec(fd)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if 0 == pid:
+            os.close(rfd)
+            for fd in others:
+                os.close(fd)
+            _worker_main(wfd, target, kwargs, limits)
+
+        os.close(wfd)
+        self.pid        = pid
+        self.fd         = rfd
+        self.started    = time.time()
+        self.restart_at = None
+        self.killed     = None
+        self.reported   = False
+        self.__buf      = ''
+
+    def read(self):
+        """
+        Read whatever the worker has sent, closing the pipe on EOF.
+        Returns the failures reported in any complete lines, as tuples of
+        stack, WorkerFailure, fingerprint and whether it was fatal.
+        """
+        data = os.read(self.fd, 65536)
+        if not data:
+            os.close(self.fd)
+            self.fd = None
+            data = '\n'
+
+        lines = (self.__buf + data).split('\n')
+        self.__buf = lines.pop()
+
+        failures = [ ]
+        for line in lines:
+            if not line.strip():
+                continue
+            report = json.loads(line)
+            error = WorkerFailure(self.slot, self.pid, report['summary'],
+                                  report['stack'])
+            if report['fatal']:
+                self.reported = True
+            failures.append((report['stack'], error, report['fingerprint'],
+                             report['fatal']))
+        return failures
+
+    def finish(self, status):
+        """
+        Called once the worker has been reaped with its exit status.
+        Returns the failures it reported which haven't yet been read and,
+        if it died without reporting why, one describing its death, as
+        read() does; the list is empty if the target returned normally.
+        """
+        # only take what has already been written: anything the target
+        # forked may still hold the write end open long after it exits.
+        failures = [ ]
+        while self.fd is not None and select.select([self.fd], [], [], 0)[0]:
+            failures.extend(self.read())
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        pid, self.pid = self.pid, None
+        if self.reported:
+            return failures
+
+        if self.killed:
+            summary = self.killed
+        elif os.WIFSIGNALED(status) and signal.SIGXCPU == os.WTERMSIG(status):
+            summary = 'exceeded CPU limit'
+        elif os.WIFSIGNALED(status):
+            summary = 'killed by signal %d' % os.WTERMSIG(status)
+        elif os.WEXITSTATUS(status):
+            summary = 'exited with status %d' % os.WEXITSTATUS(status)
+        else:
+            return failures
+
+        stack = 'worker %d (pid %d) %s\n' % (self.slot, pid, summary)
+        fp = hashlib.sha1(summary).hexdigest()[:16]
+        error = WorkerFailure(self.slot, pid, summary, stack)
+        failures.append((stack, error, fp, True))
+        return failures
+
+    def rss(self):
+        """
+        Resident set size of the worker in bytes, or None if it can't be
+        read (i.e. on platforms without /proc).
+        """
+        try:
+            with open('/proc/%d/statm' % self.pid) as statm:
+                pages = int(statm.read().split()[1])
+        except (IOError, IndexError, ValueError):
+            return None
+        return pages * resource.getpagesize()
+
+    def cpu_time(self):
+        """
+        CPU time used by the worker in seconds, or None if it can't be
+        read.
+        """
+        try:
+            with open('/proc/%d/stat' % self.pid) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            return None
+        ticks = int(fields[11]) + int(fields[12])
+        return float(ticks) / os.sysconf('SC_CLK_TCK')
 
-            if development_p():
-                _handle_development(stack, error)
-            if staging_p():
-                _handle_staging(stack, error)
-            if production_p():
-                _handle_production(stack)
+    def kill(self, reason, sig = signal.SIGKILL):
+        if not self.pid:
+            return
+        self.killed = reason
+        try:
+            os.kill(self.pid, sig)
+        except OSError as e:
+            if errno.ESRCH != e.errno:
+                raise
+
+
+def _cloexec(fd):
+    """
+    keep fd out of anything a worker's target goes on to exec.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def _worker_main(fd, target, kwargs, limits):
+    """
+    Body of a worker process: apply the resource limits and run the
+    target once, reporting any exception to the supervisor. Never returns.
+    """
+    max_rss, max_cpu = limits
+    status = 0
+    if GLOBALS['status']:
+        GLOBALS['status'].socket.close()
 
+    lock = threading.Lock()
+    def send(report):
+        with lock:
+            os.write(fd, json.dumps(report) + '\n')
 
-def initialise(devs=None, sender=None):
+    def stalled(error, last):
+        stack, fp = thread_stacks(main)
+        stack = 'target stalled: %s\n\n%s' % (error, stack)
+        send({ 'summary': str(error), 'stack': stack, 'fingerprint': fp,
+               'fatal': GLOBALS['stall_restart'] })
+        if GLOBALS['stall_restart']:
+            os._exit(1)
+
+    main = threading.current_thread().ident
+    GLOBALS['heartbeat'] = time.time()
+    GLOBALS['watchdog']  = None         # the parent's isn't running here
+    _start_watchdog(stalled)
+
+    try:
+        if max_cpu:
+            resource.setrlimit(resource.RLIMIT_CPU, (max_cpu, max_cpu + 1))
+        if max_rss and not os.path.exists('/proc/self/statm'):
+            # no way for the supervisor to watch RSS, so cap address
+            # space instead.
+            resource.setrlimit(resource.RLIMIT_AS, (max_rss, max_rss))
+
+        if kwargs:
+            target(**kwargs)
+        else:
+            target()
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as error:
+        if error.code is not None and not isinstance(error.code, int):
+            status = 1
+        else:
+            status = error.code or 0
+    except BaseException as error:
+        stack = _dump_traceback(error)[0]
+        report = { 'summary': '%s: %s' % (type(error).__name__, error),
+                   'stack': stack.read(),
+                   'fingerprint': stack.fingerprint(),
+                   'fatal': True }
+        status = 1
+        try:
+            send(report)
+        except Exception:
+            pass
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def supervise(target, workers=2, max_rss=None, max_cpu=None, **kwargs):
+    """
+    Run target in workers forked processes, restarting each one as it
+    fails according to its own copy of the restart policy. Exceptions in
+    a worker, and workers dying, are handled by the supervisor as the mode
+    dictates; in development mode the first failure stops every worker and
+    is raised. max_rss caps each worker's resident memory in bytes and
+    max_cpu its CPU time in seconds per run; a worker over either is
+    killed and restarted.
+    """
+    _setup()
+    pool = [ Worker(slot, GLOBALS['restart'].clone())
+             for slot in range(workers) ]
+    GLOBALS['workers'] = pool
+
+    try:
+        while True:
+            now = time.time()
+            for worker in pool:
+                if worker.restart_at is not None and worker.restart_at <= now:
+                    others = [ w.fd for w in pool if w.fd is not None ]
+                    worker.start(target, kwargs, (max_rss, max_cpu), others)
+
+            pending = [ w.restart_at - now for w in pool
+                        if w.restart_at is not None ]
+            timeout = max(0, min(pending + [ 1.0 ]))
+            fds = [ w.fd for w in pool if w.fd is not None ]
+            try:
+                readable = select.select(fds, [ ], [ ], timeout)[0]
+            except select.error as e:
+                if errno.EINTR != e.args[0]:
+                    raise
+                readable = [ ]
+
+            for worker in pool:
+                if worker.fd in readable:
+                    for failure in worker.read():
+                        _handle_failure(*failure)
+                if max_rss and worker.pid and worker.rss() > max_rss:
+                    worker.kill('exceeded RSS limit of %d bytes' % max_rss)
+
+            _reap(pool)
+    except KeyboardInterrupt:
+        _send_digest(force=True)
+    finally:
+        for worker in pool:
+            worker.kill('supervisor exiting', signal.SIGTERM)
+        for worker in pool:
+            if worker.pid:
+                try:
+                    os.waitpid(worker.pid, 0)
+                except OSError as error:
+                    if errno.ECHILD != error.errno:
+                        raise
+                worker.pid = None
+            if worker.fd is not None:
+                os.close(worker.fd)
+
+
+def _reap(pool):
+    """
+    Collect exited workers, handle their failures and schedule their
+    restarts.
+    """
+    for worker in pool:
+        if not worker.pid:
+            continue
+        pid, status = os.waitpid(worker.pid, os.WNOHANG)
+        if not pid:
+            continue
+
+        runtime  = time.time() - worker.started
+        failures = worker.finish(status)
+        for failure in failures:
+            _handle_failure(*failure)
+
+        if not worker.reported and not [ f for f in failures if f[3] ]:
+            worker.restart_at = time.time()
+            continue
+
+        name = '%s worker %d' % (sys.argv[0], worker.slot)
+        worker.restart_at = time.time() + _restart_delay(worker.policy,
+                                                         runtime, name)
+
+
+def _cpu_time():
+    """
+    CPU time (user and system) used by this process so far.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def status():
+    """
+    Return a summary of the monitor's state as a dictionary.
+    """
+    now   = time.time()
+    modes = [ mode for mode in ('production', 'staging', 'development')
+              if GLOBALS[mode] ]
+    report = { 'mode': ','.join(modes) or None,
+               'pid': os.getpid(),
+               'uptime': now - GLOBALS['started'],
+               'last_fingerprint': GLOBALS['last_fingerprint'] }
+
+    if GLOBALS['workers']:
+        report['workers'] = [ ]
+        restarts = 0
+        for worker in GLOBALS['workers']:
+            stats = worker.policy.stats()
+            restarts += stats['restarts']
+            entry = { 'slot': worker.slot, 'pid': worker.pid,
+                      'restarts': stats['restarts'],
+                      'state': worker.pid and 'running' or stats['state'] }
+            if worker.pid:
+                entry['run_wall'] = now - worker.started
+                entry['run_cpu']  = worker.cpu_time()
+            report['workers'].append(entry)
+        report['restarts'] = restarts
+    else:
+        stats = restart_stats() or { }
+        report['restarts'] = stats.get('restarts', 0)
+        report['state'] = stats.get('state')
+        if GLOBALS['run']:
+            wall, cpu = GLOBALS['run']
+            report['run_wall'] = now - wall
+            report['run_cpu']  = _cpu_time() - cpu
+        if GLOBALS['deadline'] and GLOBALS['heartbeat']:
+            report['heartbeat_age'] = now - GLOBALS['heartbeat']
+
+    if GLOBALS['profiler']:
+        report['profiler'] = GLOBALS['profiler'].stats()
+
+    return report
+
+
+class StatusHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers GET / (or /status, or /health) with status() as JSON, and
+    GET /profile with the profiler's collapsed stacks.
+    """
+    timeout = 5                         # so a silent client can't hang on
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if '/profile' == path and GLOBALS['profiler']:
+            body  = GLOBALS['profiler'].collapsed()
+            ctype = 'text/plain'
+        elif path in ('/', '/status', '/health'):
+            body  = json.dumps(status(), sort_keys = True)
+            ctype = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket peers have no address to look up
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StatusServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixStatusServer (SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+
+
+def start_status(address):
+    """
+    Start the status server on a background thread. address is either a
+    port number (listening on localhost), a (host, port) tuple, or the
+    path of a unix socket. Returns the server.
+    """
+    if isinstance(address, basestring):
+        server = UnixStatusServer(address, StatusHandler)
+    else:
+        if isinstance(address, int):
+            address = ('127.0.0.1', address)
+        server = StatusServer(address, StatusHandler)
+
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def initialise(devs=None, sender=None, alerts=None, restart=None,
+               capture_locals=None, status=None, stall_deadline=None,
+               stall_restart=None, profiler=None):
     """
     Initialise the monitor with the list of developers to email and the
-    sender to send mail as. A global is only set if it is non-NULL.
+    sender to send mail as, and optionally an AlertPolicy and a
+    RestartPolicy. If capture_locals is set, tracebacks include the
+    (size-capped) local variables of each frame. If status is set, a
+    status server is started on it (see start_status()). stall_deadline
+    is the number of seconds the target may go without calling
+    heartbeat(), and stall_restart whether it is restarted when it does.
+    profiler is a Profiler, which is installed on its signal. A global is
+    only set if it is non-NULL.
     """
     if sender:
         GLOBALS['sender'] = sender
     if devs:
         GLOBALS['devs'] = devs
+    if alerts:
+        GLOBALS['alerts'] = alerts
+    if restart:
+        GLOBALS['restart'] = restart
+    if capture_locals is not None:
+        GLOBALS['capture_locals'] = capture_locals
+    if status and not GLOBALS['status']:
+        GLOBALS['status'] = start_status(status)
+    if stall_deadline:
+        GLOBALS['deadline'] = stall_deadline
+    if stall_restart is not None:
+        GLOBALS['stall_restart'] = stall_restart
+    if profiler:
+        GLOBALS['profiler'] = profiler
+        profiler.install()
 
 
 def test(delay=1):
@@ -237,11 +1506,10 @@ def __testf(exception_type):
 
 def _dump_traceback(error):
     """
-    internal function to dump the traceback to a string
+    internal function to record the traceback of the exception being
+    handled; it is only formatted if it is read.
     """
-    tracer = Traceback()
-    traceback.print_exc(file=tracer)
-    stack = tracer.read()
+    stack = Traceback(sys.exc_info(), GLOBALS['capture_locals'])
 
     return stack, error
 
@@ -255,27 +1523,46 @@ def _handle_development(stack, error):
     raise(error)
 
 
-def _handle_staging(stack, error):
+def _handle_staging(stack, error, fp=None):
     """
     Handle staging-mode: execute production-mode then development-mode.
     """
-    _handle_production(stack)           # first, production behaviour
-    _handle_development(stack, error)   # then, development behaviour
+    _handle_production(stack, error, fp)    # first, production behaviour
+    _handle_development(stack, error)       # then, development behaviour
 
 
-def _handle_production(stack):
+def _handle_production(stack, error=None, fp=None):
     """
-    Handle production-mode. By default, sends an email to the devs.
+    Handle production-mode. By default, sends an email to the devs,
+    unless the alert policy is holding back repeats of this failure.
     """
-    devs = GLOBALS['devs']
+    if fp and GLOBALS['alerts']:
+        summary = '%s: %s' % (type(error).__name__, error)
+        if not GLOBALS['alerts'].record(fp, summary, stack):
+            return
+
     subject = 'stack dump for %s (pid %d)' % (sys.argv[0], os.getpid())
     body = 'fault occurred at %s\n-----\n\n%s\n' % (
         datetime.datetime.utcnow(),
         stack
     )
+    if fp:
+        body += '\n fingerprint %s; repeats will be sent as a digest.' % fp
     if GLOBALS['production']:
         body += '\n execution has restarted.'
+    _send_alert(subject, body)
+
+
+def _send_alert(subject, body):
+    """
+    Email the devs.
+    """
+    devs = GLOBALS['devs']
     body += '\n (automated email sent by the python monitor module ('
     body += 'https://github.com/kisom/pymods)'
 
-    mail.simple(devs, subject=subject, body=body)
+    # don't hold up the restart on SMTP if a spool has been set up
+    if mail.get_spool():
+        mail.enqueue(devs, subject=subject, body=body)
+    else:
+        mail.simple(devs, subject=subject, body=body)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# file: asyncapi.py
+# author: kyle isom <coder@kyleisom.net>
+#
+# non-blocking variants of the rest interface
+
+import Queue
+import sys
+import threading
+
+from jsonapi import JsonApi
+from restapi import RestApi
+
+
+class Future:
+    """
+    Handle on the result of a request running in the background. Call
+    result() to block until it has finished; any exception raised by the
+    request is re-raised there.
+    """
+    __done  = None
+    __value = None
+    __error = None
+
+    def __init__(self):
+        self.__done = threading.Event()
+
+    def done(self):
+        return self.__done.isSet()
+
+    def result(self, timeout = None):
+        if not self.__done.wait(timeout):
+            raise RuntimeError('request did not finish within timeout')
+
+        if self.__error:
+            raise self.__error[0], self.__error[1], self.__error[2]
+        return self.__value
+
+    def exception(self, timeout = None):
+        try:
+            self.result(timeout)
+        except Exception as e:
+            return e
+        return None
+
+    def set_result(self, value):
+        self.__value = value
+        self.__done.set()
+
+    def set_exception(self, exc_info):
+        self.__error = exc_info
+        self.__done.set()
+
+
+def run(future, func, args):
+    try:
+        future.set_result(func(*args))
+    except Exception:
+        future.set_exception(sys.exc_info())
+
+
+class Executor:
+    """
+    Fixed-size pool of worker threads which requests are run on. Threads
+    are started on first use and are daemonic, so an idle executor won't
+    hold up interpreter exit; shutdown() stops them once the requests
+    already submitted have run.
+    """
+    workers = None
+
+    def __init__(self, workers = 8):
+        self.workers   = workers
+        self.__queue   = Queue.Queue()
+        self.__lock    = threading.Lock()
+        self.__started = False
+        self.__threads = [ ]
+        self.__closed  = False
+
+    def submit(self, func, *args):
+        future = Future()
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('executor has been shut down')
+            self.__start__()
+            self.__queue.put((future, func, args))
+        return future
+
+    def shutdown(self, wait = False):
+        """
+        Stop the worker threads once they have run every request already
+        submitted; further submissions raise RuntimeError. If wait is
+        True, block until they have exited.
+        """
+        with self.__lock:
+            if self.__closed:
+                threads = [ ]
+            else:
+                threads = self.__threads
+                for worker in threads:
+                    self.__queue.put(None)
+            self.__closed = True
+
+        if wait:
+            for worker in threads:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+    def __start__(self):
+        # called with the lock held
+        if self.__started:
+            return
+        for i in range(self.workers):
+            worker = threading.Thread(target = self.__work__)
+            worker.daemon = True
+            worker.start()
+            self.__threads.append(worker)
+        self.__started = True
+
+    def __work__(self):
+        while True:
+            job = self.__queue.get()
+            if job is None:
+                return
+            run(*job)
+            del job     # an idle thread mustn't keep its last client alive
+
+
+class AsyncApi:
+    """
+    Mixin turning the request methods of a RestApi subclass into
+    non-blocking calls. Each of get, post, patch, delete, head, rate_limit
+    and batch returns a Future; the request itself goes through the
+    synchronous class's methods on an executor thread, so headers,
+    authentication and __decode__ behave exactly as they do there.
+
+    __sync__ must be set to the synchronous class being wrapped, and
+    should come after this mixin in the base list.
+
+    Each client has its own executor threads; call close(), or use the
+    client in a with statement, to stop them when it is finished with.
+    """
+    __sync__ = None
+    executor = None
+
+    def __init__(self, *args, **kwargs):
+        concurrency   = kwargs.pop('concurrency', 8)
+
+        # executor is left unset until the synchronous constructor is
+        # done, so that __auth__ blocks as it normally would.
+        self.__sync__.__init__(self, *args, **kwargs)
+        self.executor = Executor(concurrency)
+
+    def close(self):
+        """
+        Stop the executor's threads once the requests already made have
+        finished; requests made afterwards raise RuntimeError.
+        """
+        if self.executor:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __submit__(self, func, *args):
+        if not self.executor:
+            return func(self, *args)
+        return self.executor.submit(func, self, *args)
+
+    def get(self, request, *args):
+        return self.__submit__(self.__sync__.get, request)
+
+    def post(self, request, data, *args):
+        return self.__submit__(self.__sync__.post, request, data)
+
+    def patch(self, request, data, *args):
+        return self.__submit__(self.__sync__.patch, request, data)
+
+    def delete(self, request, data = None, *args):
+        return self.__submit__(self.__sync__.delete, request, data)
+
+    def head(self, request):
+        return self.__submit__(self.__sync__.head, request)
+
+    def rate_limit(self):
+        return self.__submit__(self.__sync__.rate_limit)
+
+    def batch(self, requests, workers = 8, max_in_flight = None):
+        return self.__submit__(self.__sync__.batch, requests, workers,
+                               max_in_flight)
+
+    def __dispatch__(self, method, request, data = None):
+        # batch runs on its own threads, so it needs the blocking calls
+        func = getattr(self.__sync__, method.lower(), None)
+        if method.upper() not in self.supported_methods or not func:
+            raise ValueError('%s is an unsupported method' % method)
+        if method.upper() in ('GET', 'HEAD'):
+            return func(self, request)
+        return func(self, request, data)
+
+    def gather_get(self, paths, concurrency = None,
+                   return_exceptions = False):
+        """
+        GET every path in paths, keeping up to concurrency requests (by
+        default, the executor's size) in flight at once, and return the
+        results in the same order as paths. If return_exceptions is
+        True, a failed request's exception is put in its slot in the
+        results; otherwise the first failure is raised once every request
+        has finished.
+        """
+        paths = list(paths)
+        if not concurrency:
+            concurrency = self.executor.workers
+        concurrency = max(1, min(concurrency, len(paths)))
+
+        results = [ None ] * len(paths)
+        errors  = [ None ] * len(paths)
+        pending = Queue.Queue()
+        for i in range(len(paths)):
+            pending.put(i)
+
+        def fetch():
+            while True:
+                try:
+                    i = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = self.__sync__.get(self, paths[i])
+                except Exception:
+                    errors[i] = sys.exc_info()
+
+        workers = [ threading.Thread(target = fetch)
+                    for i in range(concurrency) ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        for i in range(len(paths)):
+            if not errors[i]:
+                continue
+            if not return_exceptions:
+                raise errors[i][0], errors[i][1], errors[i][2]
+            results[i] = errors[i][1]
+
+        return results
+
+
+class AsyncRestApi (AsyncApi, RestApi):
+    __sync__ = RestApi
+
+
+class AsyncJsonApi (AsyncApi, JsonApi):
+    __sync__ = JsonApi
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# file: cache.py
+# author: kyle isom <coder@kyleisom.net>
+#
+# conditional-request response cache for the rest interface
+
+import collections
+import cPickle
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class Entry:
+    """
+    A cached response: the status and processed body, the validators
+    needed to revalidate it, and (for JsonApi) the already-decoded body.
+    """
+    status        = None
+    data          = None
+    etag          = None
+    last_modified = None
+    decoded       = None
+    size          = None
+
+    def __init__(self, status, data, etag = None, last_modified = None,
+                 decoded = None):
+        self.status        = status
+        self.data          = data
+        self.etag          = etag
+        self.last_modified = last_modified
+        self.decoded       = decoded
+        self.size          = len(data or '')
+
+    def validators(self):
+        """
+        Return the conditional request headers for revalidating this
+        entry.
+        """
+        headers = { }
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+def make_key(api_base, request, auth_token = None):
+    """
+    Build the cache key for a request. The auth token is hashed so that
+    it never ends up in a cache file name.
+    """
+    identity = ''
+    if auth_token:
+        identity = hashlib.sha1(auth_token).hexdigest()
+    return (api_base, request, identity)
+
+
+class MemoryCache:
+    """
+    In-memory LRU cache of entries, evicting the least recently used
+    entries once the cached bodies total more than max_bytes.
+    """
+    max_bytes = None
+    size      = None
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size      = 0
+        self.__lock    = threading.Lock()
+        self.__entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry:
+                self.__entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            self.delete(key)
+            return
+
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old:
+                self.size -= old.size
+            self.__entries[key] = entry
+            self.size += entry.size
+
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.__entries.popitem(last = False)
+                self.size -= evicted.size
+
+    def delete(self, key):
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old:
+                self.size -= old.size
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class DiskCache:
+    """
+    On-disk cache, storing one pickled entry per file under path. Files
+    are written to a temporary name and renamed into place, so concurrent
+    readers never see a partial entry. Entries persist across processes
+    and are never evicted; clear() removes them all.
+    """
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __filename__(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key)).hexdigest())
+
+    def get(self, key):
+        try:
+            f = open(self.__filename__(key), 'rb')
+        except IOError:
+            return None
+
+        try:
+            try:
+                return cPickle.load(f)
+            except (EOFError, cPickle.UnpicklingError):
+                return None
+        finally:
+            f.close()
+
+    def put(self, key, entry):
+        fd, tmp = tempfile.mkstemp(dir = self.path, prefix = '.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, self.__filename__(key))
+        except:
+            os.unlink(tmp)
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self.__filename__(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            os.unlink(os.path.join(self.path, name))
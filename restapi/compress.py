@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# file: compress.py
+# author: kyle isom <coder@kyleisom.net>
+#
+# content-encoding support for the rest interface
+
+import threading
+import zlib
+
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class TransferStats:
+    """
+    Byte counters for a RestApi: bytes sent and received on the wire
+    against the size of the bodies before compression and after
+    decompression.
+    """
+    wire_out    = None
+    raw_out     = None
+    wire_in     = None
+    decoded_in  = None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.wire_out   = 0
+        self.raw_out    = 0
+        self.wire_in    = 0
+        self.decoded_in = 0
+
+    def sent(self, raw, wire):
+        with self.__lock:
+            self.raw_out  += raw
+            self.wire_out += wire
+
+    def received(self, wire, decoded):
+        with self.__lock:
+            self.wire_in    += wire
+            self.decoded_in += decoded
+
+    def snapshot(self):
+        with self.__lock:
+            return { 'wire_out': self.wire_out, 'raw_out': self.raw_out,
+                     'wire_in': self.wire_in,
+                     'decoded_in': self.decoded_in }
+
+
+def gzip(data, level = 6):
+    """
+    gzip-compress a request body.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decode_chunks(chunks, encoding, stats = None):
+    """
+    Decompress an iterable of body chunks according to the response's
+    Content-Encoding, yielding decoded chunks as they become available.
+    Bodies with no (or an unknown) encoding pass through untouched. If
+    stats is given, the wire and decoded sizes are added to it.
+    """
+    encoding = (encoding or '').strip().lower()
+    if 'gzip' == encoding or 'x-gzip' == encoding:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif 'deflate' == encoding:
+        decompressor = None                           # zlib or raw, see below
+    else:
+        encoding = None
+
+    wire    = 0
+    decoded = 0
+    for chunk in chunks:
+        wire += len(chunk)
+        if encoding:
+            # servers disagree on whether deflate means zlib-wrapped or
+            # raw deflate data, so try the former and fall back.
+            if not decompressor:
+                decompressor = zlib.decompressobj()
+                try:
+                    chunk = decompressor.decompress(chunk)
+                except zlib.error:
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    chunk = decompressor.decompress(chunk)
+            else:
+                chunk = decompressor.decompress(chunk)
+
+        if chunk:
+            decoded += len(chunk)
+            yield chunk
+
+    if encoding and decompressor:
+        chunk = decompressor.flush()
+        if chunk:
+            decoded += len(chunk)
+            yield chunk
+
+    if stats:
+        stats.received(wire, decoded)
@@ -5,16 +5,67 @@
 # rest interface
 
 import base64
+import copy
 import json
+import Queue
+import StringIO
 import sys
+import threading
 import time
+import urllib
 import urllib2
+import urlparse
 
+from jsonstream import iter_array, iter_lines
 from restapi import RestApi
 
 
+def next_link(header):
+    """
+    Return the target of the rel="next" entry in a Link header, or None.
+    """
+    if not header:
+        return None
+
+    for link in header.split(','):
+        parts = link.split(';')
+        target = parts[0].strip()
+        if not (target.startswith('<') and target.endswith('>')):
+            continue
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            rels = value.strip('"\'').split()
+            if 'rel' == name.strip().lower() and 'next' in rels:
+                return target[1:-1]
+    return None
+
+
+def lookup(obj, field):
+    """
+    Look up a dotted field name (i.e. 'meta.next') in a decoded document,
+    returning None if any part of it is missing.
+    """
+    for name in field.split('.'):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(name)
+    return obj
+
+
+def set_param(request, name, value):
+    """
+    Set a query parameter on a request path, replacing any existing value.
+    """
+    path, _, query = request.partition('?')
+    params = [ (k, v) for k, v in urlparse.parse_qsl(query, True)
+               if k != name ]
+    params.append((name, value))
+    return '%s?%s' % (path, urllib.urlencode(params))
+
+
 class JsonApi (RestApi):
-    
+    share_cached = False                # return cached documents uncopied
+
     def __set_default_content_type__(self):
         self.__trace__('setting content type application/json')
         self.content_t = 'application/json'
@@ -30,12 +81,139 @@ class JsonApi (RestApi):
             return res
 
     def get(self, request, *args):
+        """
+        GET and decode request. With a response cache, the document is
+        decoded once per response and a deep copy returned, so callers
+        are free to modify it; set share_cached to get the cached
+        document itself, which must then be treated as read-only.
+        """
+        if self.cache is not None:
+            res = self.__cached_get__(request, self.__decode__).decoded
+            if self.share_cached:
+                return res
+            return copy.deepcopy(res)
+
         res = RestApi.get(self, request, args)
         if res:
             res = self.__decode__(res['data'])
 
         return res
 
+    def stream(self, request, lines = False, chunk_size = 64 * 1024):
+        """
+        GET a large collection without holding it in memory: reads the
+        response in chunks and yields the elements of the top-level JSON
+        array (or, if lines is True, each JSON-lines record) as soon as
+        they have been decoded. Raises ValueError on malformed JSON.
+        """
+        chunks = self.__stream__(request, chunk_size)
+        if lines:
+            return iter_lines(chunks)
+        return iter_array(chunks)
+
+    def __page__(self, request, cursor_field, cursor_param):
+        """
+        Fetch and decode a single page, returning the page and the request
+        for the one after it (or None if it is the last).
+        """
+        self.__trace__( 'page->%s' % request )
+        response, body = self.__exchange__('GET', request)
+        if 200 != response.status:
+            raise urllib2.HTTPError(request, response.status,
+                                    response.reason, response.msg,
+                                    StringIO.StringIO(body))
+
+        page = self.__decode__(self.__process_data__(body))
+        if cursor_field:
+            cursor = lookup(page, cursor_field)
+            if not cursor:
+                return page, None
+            return page, set_param(request, cursor_param, cursor)
+
+        link = next_link(response.getheader('link'))
+        if not link:
+            return page, None
+
+        # only the path is needed; the host is always api_base.
+        url = urlparse.urlsplit(link)
+        return page, urlparse.urlunsplit(('', '', url.path or '/',
+                                          url.query, ''))
+
+    def iter_pages(self, request, cursor_field = None,
+                   cursor_param = 'cursor', lookahead = 1):
+        """
+        Walk a paginated collection, yielding each decoded page. Pages are
+        followed through the Link header's rel="next" entry or, if
+        cursor_field is given, by passing that (dotted) field of each page
+        back as the cursor_param query parameter.
+
+        Up to lookahead pages are fetched ahead on a background thread
+        while the caller works on the current one; a lookahead of 0
+        fetches each page only when it is asked for. A page other than
+        200 raises urllib2.HTTPError.
+        """
+        if not lookahead:
+            while request:
+                page, request = self.__page__(request, cursor_field,
+                                              cursor_param)
+                yield page
+            return
+
+        pages = Queue.Queue(lookahead)
+        stop  = threading.Event()
+        done  = object()
+
+        def put(item):
+            while not stop.isSet():
+                try:
+                    pages.put(item, timeout = 0.1)
+                    return True
+                except Queue.Full:
+                    continue
+            return False
+
+        def prefetch(request):
+            try:
+                while request:
+                    page, request = self.__page__(request, cursor_field,
+                                                  cursor_param)
+                    if not put((page, None)):
+                        return
+            except Exception:
+                put((None, sys.exc_info()))
+                return
+            put((done, None))
+
+        fetcher = threading.Thread(target = prefetch, args = (request, ))
+        fetcher.daemon = True
+        fetcher.start()
+
+        try:
+            while True:
+                page, error = pages.get()
+                if error:
+                    raise error[0], error[1], error[2]
+                if page is done:
+                    return
+                yield page
+        finally:
+            stop.set()
+
+    def iter_items(self, request, items_field = None, cursor_field = None,
+                   cursor_param = 'cursor', lookahead = 1):
+        """
+        Walk a paginated collection as iter_pages does, yielding the
+        individual items on each page. If items_field is given, the items
+        are that (dotted) field of each page; otherwise each page should
+        be a list.
+        """
+        for page in self.iter_pages(request, cursor_field, cursor_param,
+                                    lookahead):
+            if items_field:
+                page = lookup(page, items_field)
+            for item in page or [ ]:
+                yield item
+
     def post(self, request, data, *args):
         if not type(data) == type(str()):
             data = json.dumps(data)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# file: jsonstream.py
+# author: kyle isom <coder@kyleisom.net>
+#
+# incremental decoding of large JSON documents
+
+import itertools
+import json
+
+WHITESPACE  = ' \t\r\n'
+DELIMITERS  = WHITESPACE + ',]'
+MAX_ELEMENT = 64 * 1024 * 1024
+
+
+def read_chunks(f, chunk_size = 64 * 1024):
+    """
+    Yield successive chunks read from a file-like object until EOF.
+    """
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_array(chunks, decoder = None, max_element = MAX_ELEMENT):
+    """
+    Decode a top-level JSON array from an iterable of string chunks,
+    yielding each element as soon as it has been read in full. Only the
+    element currently being decoded is held in memory, and an element of
+    more than max_element bytes is rejected rather than read to the end
+    of the stream. Raises ValueError on malformed input, including
+    anything but whitespace after the array.
+    """
+    if not decoder:
+        decoder = json.JSONDecoder()
+
+    buf     = ''
+    pos     = 0
+    skipped = 0                 # stream offset of buf[0]
+    started = False
+    comma   = False
+    chunks  = iter(chunks)
+
+    while True:
+        # skip whitespace and separators, pulling in more data as needed
+        while True:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buf):
+                break
+            skipped += len(buf)
+            buf = next(chunks, None)
+            pos = 0
+            if buf is None:
+                raise ValueError('unexpected end of JSON array')
+
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError('expected a JSON array')
+            started = True
+            first   = True
+            pos    += 1
+            continue
+
+        if buf[pos] == ']':
+            if comma:
+                raise ValueError('trailing , at offset %d' % (skipped + pos))
+            # read the source to the end, so a response can be reused,
+            # noting where anything other than whitespace follows.
+            extra    = None
+            skipped += pos + 1
+            for chunk in itertools.chain([ buf[pos + 1:] ], chunks):
+                if extra is None and chunk.strip(WHITESPACE):
+                    lead  = len(chunk) - len(chunk.lstrip(WHITESPACE))
+                    extra = skipped + lead
+                skipped += len(chunk)
+            if extra is not None:
+                raise ValueError('extra data after JSON array at offset %d'
+                                 % extra)
+            return
+        if not first:
+            if buf[pos] != ',':
+                raise ValueError('expected , at offset %d' % (skipped + pos))
+            pos += 1
+            first = True
+            comma = True
+            continue
+
+        # decode the next element, reading more until it is complete. a
+        # number is only accepted once it is followed by a delimiter, as
+        # otherwise it may have been cut short at the end of the buffer.
+        # after a failed attempt, nothing is tried again until the element
+        # has at least doubled, so a large element is decoded only a
+        # logarithmic number of times rather than once per chunk. one that
+        # still won't decode once over max_element bytes is given up on,
+        # so a syntax error can't buffer the rest of the stream.
+        pending = [ ]
+        size    = len(buf) - pos
+        eof     = False
+        while True:
+            if pending:
+                skipped += pos
+                buf      = buf[pos:] + ''.join(pending)
+                pos      = 0
+                pending  = [ ]
+
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            if end is not None and end < len(buf):
+                if not isinstance(value, (int, long, float)):
+                    break
+                if buf[end] in DELIMITERS:
+                    break
+
+            if eof:
+                if end is None:
+                    raise ValueError('truncated JSON array element at '
+                                     'offset %d' % (skipped + pos))
+                break
+            if size > max_element:
+                raise ValueError('JSON array element at offset %d is over '
+                                 '%d bytes' % (skipped + pos, max_element))
+
+            wanted = min(2 * (len(buf) - pos), max_element + 1)
+            while size < wanted:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                    break
+                pending.append(chunk)
+                size += len(chunk)
+
+        yield value
+        first = False
+        comma = False
+        pos   = end
+
+
+def iter_lines(chunks, decoder = None):
+    """
+    Decode JSON-lines (one JSON document per line) from an iterable of
+    string chunks, yielding each record as its line is completed. Blank
+    lines are skipped.
+    """
+    if not decoder:
+        decoder = json.JSONDecoder()
+
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail  = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield decoder.decode(line)
+
+    if tail.strip():
+        yield decoder.decode(tail)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# file: metrics.py
+# author: kyle isom <coder@kyleisom.net>
+#
+# request timing and throughput metrics for the rest interface
+
+import httplib
+import re
+import socket
+import ssl
+import threading
+import time
+
+# latency histogram bucket bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES  = ('dns', 'connect', 'tls', 'ttfb', 'total')
+
+# requests past a registry's max_keys are recorded under this key
+OVERFLOW = ('*', '*', ':overflow')
+
+ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F]{8,}|'
+                        r'[0-9a-fA-F]{8}-[0-9a-fA-F-]{27})$')
+
+
+def path_template(request):
+    """
+    Reduce a request path to a template for grouping metrics, dropping
+    the query string and replacing ID-like segments (numbers, long hex
+    strings and UUIDs) with ':id'; i.e. /users/1234/repos?page=2 becomes
+    /users/:id/repos.
+    """
+    path = request.split('?', 1)[0]
+    return '/'.join([ ID_SEGMENT.match(part) and ':id' or part
+                      for part in path.split('/') ])
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values, as Prometheus expects.
+    """
+    bounds = None
+    counts = None
+    total  = None
+    count  = None
+
+    def __init__(self, bounds = BUCKETS):
+        self.bounds = bounds
+        self.counts = [ 0 ] * len(bounds)
+        self.total  = 0.0
+        self.count  = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        for i in range(len(self.bounds)):
+            if value <= self.bounds[i]:
+                self.counts[i] += 1
+
+    def snapshot(self):
+        return { 'buckets': zip(self.bounds, self.counts),
+                 'sum': self.total, 'count': self.count }
+
+
+class Registry:
+    """
+    In-process store of request metrics: per-phase latency histograms for
+    each (host, method, path template), response counts by status, and
+    bytes sent and received. A registry may be shared across threads and
+    RestApi instances. At most max_keys (host, method, path template)
+    keys are kept; requests for any further ones are recorded together
+    under OVERFLOW, so memory use stays bounded when paths aren't.
+    """
+    max_keys = None
+
+    def __init__(self, max_keys = 1000):
+        self.max_keys = max_keys
+        self.__lock   = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.__histograms = { }
+        self.__statuses   = { }
+        self.__errors     = 0
+        self.__bytes_in   = 0
+        self.__bytes_out  = 0
+
+    def record(self, host, method, request, status, timings,
+               bytes_in = 0, bytes_out = 0):
+        """
+        Record a finished request. timings maps phase names to seconds;
+        phases that didn't happen (i.e. DNS on a reused connection) are
+        left out. A status of None records a failed request.
+        """
+        key = (host, method, path_template(request))
+        with self.__lock:
+            histograms = self.__histograms.get(key)
+            if not histograms and len(self.__histograms) >= self.max_keys:
+                key = OVERFLOW
+                histograms = self.__histograms.get(key)
+            if not histograms:
+                histograms = dict([ (phase, Histogram())
+                                    for phase in PHASES ])
+                self.__histograms[key] = histograms
+
+            for phase, seconds in timings.items():
+                histograms[phase].observe(seconds)
+
+            if status is None:
+                self.__errors += 1
+            else:
+                self.__statuses[status] = self.__statuses.get(status, 0) + 1
+            self.__bytes_in  += bytes_in
+            self.__bytes_out += bytes_out
+
+    def snapshot(self):
+        """
+        Return a copy of the current metrics as plain dictionaries.
+        """
+        with self.__lock:
+            requests = { }
+            for key, histograms in self.__histograms.items():
+                requests[key] = dict([ (phase, hist.snapshot())
+                                       for phase, hist in histograms.items()
+                                       if hist.count ])
+            return { 'requests': requests,
+                     'statuses': dict(self.__statuses),
+                     'errors': self.__errors,
+                     'bytes_in': self.__bytes_in,
+                     'bytes_out': self.__bytes_out }
+
+    def prometheus(self, prefix = 'restapi'):
+        """
+        Dump the metrics in the Prometheus text exposition format.
+        """
+        snap  = self.snapshot()
+        lines = [ '# TYPE %s_request_seconds histogram' % prefix ]
+        for (host, method, path), phases in sorted(snap['requests'].items()):
+            for phase, hist in sorted(phases.items()):
+                labels = 'host="%s",method="%s",path="%s",phase="%s"' % (
+                    escape(host), method, escape(path), phase)
+                for bound, count in hist['buckets']:
+                    lines.append('%s_request_seconds_bucket{%s,le="%s"} %d'
+                                 % (prefix, labels, bound, count))
+                lines.append('%s_request_seconds_bucket{%s,le="+Inf"} %d'
+                             % (prefix, labels, hist['count']))
+                lines.append('%s_request_seconds_sum{%s} %f'
+                             % (prefix, labels, hist['sum']))
+                lines.append('%s_request_seconds_count{%s} %d'
+                             % (prefix, labels, hist['count']))
+
+        lines.append('# TYPE %s_responses_total counter' % prefix)
+        for status, count in sorted(snap['statuses'].items()):
+            lines.append('%s_responses_total{status="%d"} %d'
+                         % (prefix, status, count))
+        lines.append('# TYPE %s_errors_total counter' % prefix)
+        lines.append('%s_errors_total %d' % (prefix, snap['errors']))
+        lines.append('# TYPE %s_bytes_received_total counter' % prefix)
+        lines.append('%s_bytes_received_total %d' % (prefix,
+                                                      snap['bytes_in']))
+        lines.append('# TYPE %s_bytes_sent_total counter' % prefix)
+        lines.append('%s_bytes_sent_total %d' % (prefix, snap['bytes_out']))
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def open_socket(conn):
+    """
+    Connect conn's socket the way httplib would, but resolving the host
+    separately so the DNS lookup and the TCP connect can be timed apart.
+    Timings are stored in conn.timings.
+    """
+    start = time.time()
+    infos = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+    resolved = time.time()
+
+    error = None
+    for family, socktype, proto, canonname, address in infos:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if conn.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(conn.timeout)
+            if conn.source_address:
+                sock.bind(conn.source_address)
+            sock.connect(address)
+            break
+        except socket.error as e:
+            error = e
+            if sock:
+                sock.close()
+            sock = None
+
+    if not sock:
+        raise error or socket.error('getaddrinfo returns an empty list')
+
+    conn.timings = { 'dns': resolved - start,
+                     'connect': time.time() - resolved }
+    return sock
+
+
+class TimedHTTPConnection (httplib.HTTPConnection):
+    timings = None
+
+    def connect(self):
+        if self._tunnel_host:
+            return httplib.HTTPConnection.connect(self)
+        self.sock = open_socket(self)
+
+
+class TimedHTTPSConnection (httplib.HTTPSConnection):
+    timings = None
+
+    def connect(self):
+        if self._tunnel_host:
+            return httplib.HTTPSConnection.connect(self)
+
+        sock  = open_socket(self)
+        start = time.time()
+        context = getattr(self, '_context', None)
+        if context:
+            self.sock = context.wrap_socket(sock, server_hostname = self.host)
+        else:
+            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+        self.timings['tls'] = time.time() - start
+
+
+default_registry = Registry()
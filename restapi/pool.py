@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# file: pool.py
+# author: kyle isom <coder@kyleisom.net>
+#
+# keep-alive connection pool for the rest interface
+
+import select
+import threading
+import time
+
+from metrics import TimedHTTPConnection, TimedHTTPSConnection
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of HTTP/1.1 keep-alive connections, kept per host. A
+    connection is checked out with acquire() and handed back with
+    release(); connections idle for longer than idle_timeout seconds, or
+    which the peer has closed, are dropped rather than reused. At most
+    max_size idle connections are kept for each host.
+    """
+    max_size     = None
+    idle_timeout = None
+    timeout      = None                               # socket timeout
+
+    def __init__(self, max_size = 8, idle_timeout = 60, timeout = None):
+        self.max_size     = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout      = timeout
+        self.__lock       = threading.Lock()
+        self.__idle       = { }
+        self.__slots      = { }
+
+    def connect(self, host, secure = False):
+        """
+        Open a new, unpooled connection to host.
+        """
+        if secure:
+            conn_t = TimedHTTPSConnection
+        else:
+            conn_t = TimedHTTPConnection
+
+        if self.timeout is None:
+            return conn_t(host)
+        return conn_t(host, timeout = self.timeout)
+
+    def acquire(self, host, secure = False):
+        """
+        Check out a connection to host. Returns a tuple of the connection
+        and a boolean indicating whether it was reused from the pool.
+        """
+        key  = (host, bool(secure))
+        now  = time.time()
+        conn = None
+
+        with self.__lock:
+            idle = self.__idle.get(key, [ ])
+            while idle:
+                candidate, stamp = idle.pop()
+                if now - stamp < self.idle_timeout and alive(candidate):
+                    conn = candidate
+                    break
+                candidate.close()
+
+        if conn:
+            return conn, True
+        return self.connect(host, secure), False
+
+    def release(self, host, secure, conn, reusable = True):
+        """
+        Hand a connection back to the pool. If the connection can't be
+        reused (the server asked to close it, the response wasn't fully
+        read, or the pool is full) it is closed instead.
+        """
+        if not reusable or not alive(conn):
+            conn.close()
+            return
+
+        key = (host, bool(secure))
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [ ])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+
+        conn.close()
+
+    def slots(self, host, limit):
+        """
+        Return the semaphore limiting the number of requests in flight to
+        host. There is one per host, shared by everyone using the pool;
+        limit sets its size when it is first asked for, and is ignored
+        after that.
+        """
+        with self.__lock:
+            slots = self.__slots.get(host)
+            if not slots:
+                slots = threading.BoundedSemaphore(limit)
+                self.__slots[host] = slots
+            return slots
+
+    def close(self):
+        """
+        Close every idle connection in the pool.
+        """
+        with self.__lock:
+            pools = self.__idle.values()
+            self.__idle = { }
+
+        for idle in pools:
+            for conn, stamp in idle:
+                conn.close()
+
+    def size(self, host = None, secure = False):
+        """
+        Return the number of idle connections held, either for a single
+        host or across the whole pool.
+        """
+        with self.__lock:
+            if host:
+                return len(self.__idle.get((host, bool(secure)), [ ]))
+            return sum([ len(idle) for idle in self.__idle.values() ])
+
+
+def alive(conn):
+    """
+    Check whether a connection's socket is still usable. An idle keep-alive
+    socket should never be readable; if it is, the peer has either closed
+    it or sent something unsolicited, and either way it can't be reused.
+    """
+    if not conn.sock:
+        return False
+
+    try:
+        readable, _, _ = select.select([ conn.sock ], [ ], [ ], 0)
+    except (select.error, ValueError):
+        return False
+    return not readable
+
+
+default_pool = ConnectionPool()
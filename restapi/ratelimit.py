@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# file: ratelimit.py
+# author: kyle isom <coder@kyleisom.net>
+#
+# client-side pacing driven by server rate limit headers
+
+import threading
+import time
+
+from retry import parse_retry_after
+
+
+def parse_headers(headers):
+    """
+    Pull the rate limit fields out of a list of (header, value) pairs, as
+    returned by getheaders(). Returns a tuple of (remaining, limit, reset),
+    with -1 for any field the server didn't send.
+    """
+    remaining = -1
+    limit     = -1
+    reset     = -1
+
+    for header, value in headers:
+        header = header.lower()
+        try:
+            if 'ratelimit-remaining' in header:
+                remaining = int(value)
+            elif 'ratelimit-limit' in header:
+                limit = int(value)
+            elif 'ratelimit-reset' in header:
+                reset = int(float(value))
+        except ValueError:
+            continue
+
+    return remaining, limit, reset
+
+
+class TokenBucket:
+    """
+    Token bucket tracking a single API's quota. The server's view of the
+    quota is authoritative: every response resets the bucket to the
+    remaining count it reports, and the refill rate is worked out from
+    the limit and the reset time (or the window, if no reset is sent).
+    """
+    capacity  = None
+    tokens    = None
+    rate      = None                                  # tokens per second
+    window    = None
+    updated   = None
+
+    def __init__(self, capacity, window = 3600):
+        self.capacity = capacity
+        self.tokens   = float(capacity)
+        self.window   = window
+        self.rate     = float(capacity) / window
+        self.updated  = time.time()
+
+    def __refill__(self, now):
+        self.tokens  = min(self.capacity,
+                           self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now = None):
+        """
+        Take a token, returning the number of seconds the caller has to
+        wait before it may use it.
+        """
+        if now is None:
+            now = time.time()
+
+        self.__refill__(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def update(self, remaining, limit, reset = -1, now = None):
+        if now is None:
+            now = time.time()
+
+        if limit > 0:
+            self.capacity = limit
+        if remaining < 0:
+            return
+
+        # a reset larger than the window is an epoch timestamp, otherwise
+        # it's a number of seconds.
+        if reset > self.window:
+            reset -= now
+        if reset > 0:
+            self.rate = float(max(remaining, 1)) / reset
+        else:
+            self.rate = float(self.capacity) / self.window
+
+        self.tokens  = float(remaining)
+        self.updated = now
+
+    def drain(self, now = None):
+        """
+        Empty the bucket, e.g. after the server has answered 429.
+        """
+        if now is None:
+            now = time.time()
+        self.tokens  = 0.0
+        self.updated = now
+
+
+class RateLimiter:
+    """
+    Paces requests per API base so they stay under the server's quota.
+    acquire() is called before each request and blocks for as long as the
+    API's bucket is empty; observe() is fed every response's headers.
+    Until a response carrying rate limit headers has been seen for an
+    API, requests to it aren't paced; a 429 without them only holds
+    requests back for its Retry-After, or if it has none for backoff
+    seconds, doubling with each 429 in a row up to max_backoff. A limiter
+    may be shared by any number of threads and RestApi instances.
+    """
+    window          = None
+    backoff         = None
+    max_backoff     = None
+    throttled_time  = None                            # seconds spent waiting
+    throttled_count = None                            # requests that waited
+
+    def __init__(self, window = 3600, backoff = 1.0, max_backoff = 60):
+        self.window          = window
+        self.backoff         = backoff
+        self.max_backoff     = max_backoff
+        self.throttled_time  = 0.0
+        self.throttled_count = 0
+        self.__lock          = threading.Lock()
+        self.__buckets       = { }
+        self.__blocked       = { }            # key -> [ until, 429s in a row ]
+        self.__stats         = { }
+
+    def acquire(self, key):
+        now = time.time()
+        with self.__lock:
+            delay   = 0
+            blocked = self.__blocked.get(key)
+            if blocked and blocked[0] > now:
+                delay = blocked[0] - now
+
+            bucket = self.__buckets.get(key)
+            if bucket:
+                delay = max(delay, bucket.reserve(now))
+            if delay:
+                self.throttled_time  += delay
+                self.throttled_count += 1
+                stats = self.__stats.setdefault(key, [ 0.0, 0 ])
+                stats[0] += delay
+                stats[1] += 1
+
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def observe(self, key, status, headers):
+        remaining, limit, reset = parse_headers(headers)
+        with self.__lock:
+            if 429 == status:
+                self.__back_off__(key, headers)
+            else:
+                self.__blocked.pop(key, None)
+
+            bucket = self.__buckets.get(key)
+            if not bucket:
+                # never guess at a quota the server hasn't told us about
+                if limit <= 0:
+                    return
+                bucket = TokenBucket(limit, self.window)
+                self.__buckets[key] = bucket
+
+            bucket.update(remaining, limit, reset)
+            if 429 == status:
+                bucket.drain()
+
+    def __back_off__(self, key, headers):
+        retry_after = None
+        for header, value in headers:
+            if 'retry-after' == header.lower():
+                retry_after = parse_retry_after(value)
+
+        blocked = self.__blocked.setdefault(key, [ 0, 0 ])
+        if retry_after is None:
+            retry_after = self.backoff * (2 ** blocked[1])
+        blocked[0]  = time.time() + min(retry_after, self.max_backoff)
+        blocked[1] += 1
+
+    def quota(self, key):
+        """
+        Return the (remaining, limit) last reported for an API, or
+        (-1, -1) if nothing has been seen.
+        """
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if not bucket:
+                return -1, -1
+            return int(max(bucket.tokens, 0)), bucket.capacity
+
+    def stats(self, key = None):
+        """
+        Return throttling counters, either for a single API or in total,
+        as a dictionary.
+        """
+        with self.__lock:
+            if key:
+                seconds, count = self.__stats.get(key, [ 0.0, 0 ])
+            else:
+                seconds, count = self.throttled_time, self.throttled_count
+        return { 'throttled_time': seconds, 'throttled_count': count }
@@ -6,8 +6,20 @@
 
 import base64
 import httplib
+import Queue
+import socket
+import StringIO
+import threading
+import time
 import urllib2
 
+from cache import Entry, make_key
+from compress import ACCEPT_ENCODING, TransferStats, decode_chunks, gzip
+from jsonstream import read_chunks
+from metrics import default_registry
+from pool import default_pool
+from ratelimit import parse_headers
+
 class NoAuthType(Exception):
 
     def __init__(self):
@@ -22,19 +34,67 @@ class RestApi:
     content_t  = None                                 # content type
     headers    = None                                 # default headers
     authenticated   = None
+    pool       = None                                 # connection pool
+    limiter    = None                                 # request pacing
+    quota      = None                                 # last rate limit seen
+    cache      = None                                 # GET response cache
+    retry      = None                                 # retry policy
+    breaker    = None                                 # circuit breaker
+    compress_threshold = None                         # min body to gzip
+    transfer   = None                                 # byte counters
+    metrics    = None                                 # metrics registry
 
     last_error = None
     last_req   = None
 
     supported_methods = [ 'GET', 'POST', 'PATCH', 'DELETE', 'HEAD' ]
+    idempotent_methods = [ 'GET', 'DELETE', 'HEAD' ]
 
     def __init__(self, api_base, debug = False, authtype = None,
                  username = None, password = None, auth_token = None,
-                 content_t = None):
+                 content_t = None, pool = None, limiter = None,
+                 cache = None, retry = None, breaker = None,
+                 compress_threshold = None, metrics = None):
         """
         ADD DOCS
+
+        Connections are drawn from pool, which defaults to the shared
+        pool.default_pool; pass a pool.ConnectionPool to tune its size
+        and idle timeout.
+
+        If limiter (a ratelimit.RateLimiter) is given, requests are paced
+        to stay under the quota the server reports in its rate limit
+        headers.
+
+        If cache (a cache.MemoryCache or cache.DiskCache) is given, GET
+        responses carrying an ETag or Last-Modified header are cached and
+        revalidated with conditional requests.
+
+        If retry (a retry.RetryPolicy) is given, requests failing with a
+        socket error or a retryable status are retried with backoff. If
+        breaker (a retry.CircuitBreaker) is given, requests to a host
+        which keeps failing raise retry.CircuitOpen instead of being sent.
+
+        Compressed responses are always accepted and decoded transparently.
+        If compress_threshold is set, POST and PATCH bodies of at least
+        that many bytes are sent gzipped. Byte counts are kept in transfer
+        (a compress.TransferStats).
+
+        Timings, status counts and byte counts for every request are
+        recorded in metrics, which defaults to the shared
+        metrics.default_registry; pass metrics = False to record nothing.
         """
         self.api_base = api_base.lower()
+        self.pool     = pool or default_pool
+        self.limiter  = limiter
+        self.cache    = cache
+        self.retry    = retry
+        self.breaker  = breaker
+        self.compress_threshold = compress_threshold
+        self.transfer = TransferStats()
+        if metrics is None:
+            metrics = default_registry
+        self.metrics  = metrics
 
         if self.api_base.startswith('https'):
             self.secure   = True
@@ -66,7 +126,8 @@ class RestApi:
         # build default request headers
         self.headers = {
                          'Content-Type': self.content_t,
-                         'Accept': '*/*'
+                         'Accept': '*/*',
+                         'Accept-Encoding': ACCEPT_ENCODING
                         }
         if self.authtype:
             if 'basic' == self.authtype:
@@ -101,35 +162,216 @@ class RestApi:
 
 
 
+    def __send__(self, conn, method, request, data, headers):
+        self.__write__(conn, method, request, data, headers)
+        return conn.getresponse()
+
+    def __write__(self, conn, method, request, data, headers):
+        if data:
+            conn.request(method, request, data, headers)
+        else:
+            conn.request(method, request, headers = headers)
+
+    def __request__(self, method, request, data = None, headers = None):
+        """
+        Send a request over a pooled connection, returning the connection
+        and the unread response. If a reused connection turns out to have
+        been closed by the peer, the request is retried once on a fresh
+        connection, as long as that can't send it twice.
+        """
+        if headers is None:
+            headers = self.headers
+        if self.breaker:
+            self.breaker.before(self.api_base)
+
+        try:
+            if self.limiter:
+                self.limiter.acquire(self.api_base)
+            conn, response = self.__send_pooled__(method, request, data,
+                                                  headers)
+        except:
+            # anything going wrong counts, or a half-open circuit's trial
+            # would never finish and the host would be refused for good.
+            if self.breaker:
+                self.breaker.failure(self.api_base)
+            raise
+
+        if self.breaker:
+            if response.status >= 500:
+                self.breaker.failure(self.api_base)
+            else:
+                self.breaker.success(self.api_base)
+
+        self.__observe__(response)
+        return conn, response
+
+    def __send_pooled__(self, method, request, data, headers):
+        start = time.time()
+        conn, reused = self.pool.acquire(self.api_base, self.secure)
+        written = False
+        try:
+            self.__write__(conn, method, request, data, headers)
+            written = True
+            response = conn.getresponse()
+        except (socket.error, httplib.BadStatusLine,
+                httplib.CannotSendRequest):
+            conn.close()
+            if not reused:
+                raise
+
+            # once the request has gone out the server may have acted on
+            # it, so only resend it if doing so twice is harmless.
+            if written and method not in self.idempotent_methods:
+                raise
+
+            self.__trace__('stale pooled connection, retrying')
+            conn = self.pool.connect(self.api_base, self.secure)
+            try:
+                response = self.__send__(conn, method, request, data,
+                                         headers)
+            except:
+                conn.close()
+                raise
+
+        # connection setup timings are only reported by the request that
+        # opened the connection.
+        timings = getattr(conn, 'timings', None) or { }
+        conn.timings = None
+        timings['ttfb'] = time.time() - start
+        response.timings = timings
+
+        return conn, response
+
+    def __observe__(self, response):
+        # rate limit headers come back on every response, so keep track
+        # of them here rather than probing for them separately.
+        headers = response.getheaders()
+        remaining, limit, reset = parse_headers(headers)
+        if remaining >= 0 or limit >= 0:
+            self.quota = (remaining, limit)
+
+        if self.limiter:
+            self.limiter.observe(self.api_base, response.status, headers)
+
+    def __release__(self, conn, response):
+        self.pool.release(self.api_base, self.secure, conn,
+                          not response.will_close)
+
+    def __exchange__(self, method, request, data = None, headers = None):
+        """
+        Run a request to completion, returning the response and its raw
+        body. The body is always drained so that the connection can go
+        back to the pool; callers only look at the response's headers.
+        Failed requests are retried here according to the retry policy.
+        """
+        data, headers = self.__compress__(method, data, headers)
+
+        attempt = 0
+        while True:
+            start    = time.time()
+            response = None
+            counter  = TransferStats()
+            try:
+                conn, response = self.__request__(method, request, data,
+                                                  headers)
+                try:
+                    body = ''.join(self.__decode_body__(response,
+                                                        stats = counter))
+                except:
+                    conn.close()
+                    raise
+            except (socket.error, httplib.HTTPException) as e:
+                self.__record__(method, request, None, start, counter, data)
+                if not self.retry or not self.retry.allowed(method, attempt):
+                    raise
+                delay = self.retry.delay(attempt)
+                self.__trace__('%s %s failed: %s' % (method, request, e),
+                               err = True)
+            else:
+                self.__release__(conn, response)
+                self.last_req = conn
+                self.__record__(method, request, response, start, counter,
+                                data)
+
+                retry = self.retry and self.retry.retry_status(
+                    method, attempt, response.status)
+                if not retry:
+                    return response, body
+
+                delay = self.retry.delay(attempt,
+                                         response.getheader('retry-after'))
+                if delay is None:
+                    return response, body
+                self.__trace__('%s %s returned %d' % (method, request,
+                                                      response.status),
+                               err = True)
+
+            attempt += 1
+            self.__trace__('retrying in %.2fs' % delay)
+            time.sleep(delay)
+
+    def __compress__(self, method, data, headers):
+        """
+        gzip a large POST or PATCH body, returning the body and headers to
+        send.
+        """
+        if not data or method not in ('POST', 'PATCH'):
+            return data, headers
+
+        size = len(data)
+        threshold = self.compress_threshold
+        if threshold is None or size < threshold:
+            self.transfer.sent(size, size)
+            return data, headers
+
+        data    = gzip(data)
+        headers = dict(headers or self.headers)
+        headers['Content-Encoding'] = 'gzip'
+        self.transfer.sent(size, len(data))
+        return data, headers
+
+    def __decode_body__(self, response, chunk_size = 64 * 1024,
+                        stats = None):
+        return decode_chunks(read_chunks(response, chunk_size),
+                             response.getheader('content-encoding'),
+                             stats or self.transfer)
+
+    def __record__(self, method, request, response, start, counter, data):
+        """
+        Record a finished (or, if response is None, failed) request's
+        byte counts and timings.
+        """
+        self.transfer.received(counter.wire_in, counter.decoded_in)
+        if not self.metrics:
+            return
+
+        timings = { }
+        status  = None
+        if response:
+            timings = dict(getattr(response, 'timings', None) or { })
+            status  = response.status
+        timings['total'] = time.time() - start
+        self.metrics.record(self.api_base, method, request, status, timings,
+                            counter.wire_in, len(data or ''))
+
     def __fetch__(self, request, data = None, method = "GET", return_response = False):
         self.__trace__( 'building request...' )
         if not method in self.supported_methods:
             self.__trace__('%s is an unsupported method!' % method)
             return None
 
-        if not self.secure:
-            req = httplib.HTTPConnection(self.api_base)
-        else:
-            req = httplib.HTTPSConnection(self.api_base)
-
-        if data:
-            req.request(method, request, data, self.headers)
-        else:
-            req.request(method, request, headers = self.headers)
-
-        response = req.getresponse()
+        response, body = self.__exchange__(method, request, data)
 
         if not return_response:
             if response.status == 204:
                 res = True
             else:
                 res = { 'status': response.status,
-                        'data': self.__process_data__(response.read()) }
+                        'data': self.__process_data__(body) }
 
         else:
             res = response
             
-        self.last_req = req
         self.__trace__( 'request->%s' % request )
         #self.__trace__('request type: %s' % req.get_method())
 
@@ -141,6 +383,75 @@ class RestApi:
     def __process_data__(self, data):
         return data
 
+    def __stream__(self, request, chunk_size = 64 * 1024):
+        """
+        GET request whose body is yielded in chunks as it arrives rather
+        than read in full. A response other than 200 raises
+        urllib2.HTTPError. The connection is returned to the pool once
+        the body has been read to the end, and closed if the caller stops
+        early.
+        """
+        self.__trace__( 'streaming request->%s' % request )
+        start   = time.time()
+        counter = TransferStats()
+        conn, response = self.__request__('GET', request)
+        self.last_req  = conn
+
+        if 200 != response.status:
+            body = ''.join(self.__decode_body__(response, stats = counter))
+            self.__release__(conn, response)
+            self.__record__('GET', request, response, start, counter, None)
+            raise urllib2.HTTPError(request, response.status,
+                                    response.reason, response.msg,
+                                    StringIO.StringIO(body))
+
+        finished = False
+        try:
+            for chunk in self.__decode_body__(response, chunk_size, counter):
+                yield chunk
+            finished = True
+        finally:
+            if finished:
+                self.__release__(conn, response)
+            else:
+                conn.close()
+            self.__record__('GET', request, response, start, counter, None)
+
+    def __cached_get__(self, request, decode = None):
+        """
+        GET request through the response cache, returning a cache.Entry.
+        A cached entry is revalidated with a conditional request and
+        served as-is on a 304. If decode is given, it is applied to fresh
+        bodies and the result kept in the entry, so a 304 skips decoding
+        as well. Cached entries are shared: don't modify them.
+        """
+        key     = make_key(self.api_base, request, self.auth_token)
+        entry   = self.cache.get(key)
+        headers = self.headers
+        if entry:
+            headers = dict(self.headers)
+            headers.update(entry.validators())
+
+        self.__trace__( 'request->%s' % request )
+        response, body = self.__exchange__('GET', request, headers = headers)
+        if 304 == response.status and entry:
+            self.__trace__('not modified, using cached response')
+            return entry
+
+        entry = Entry(response.status, self.__process_data__(body),
+                      response.getheader('etag'),
+                      response.getheader('last-modified'))
+        if decode:
+            entry.decoded = decode(entry.data)
+
+        cacheable = entry.etag or entry.last_modified
+        if 200 == response.status and cacheable:
+            self.cache.put(key, entry)
+        else:
+            self.cache.delete(key)
+
+        return entry
+
     def __auth__(self):
         if 'basic' == self.authtype:
             try:
@@ -160,7 +471,13 @@ class RestApi:
 
     def get(self, request, *args):
         #self.___trace__('sending GET request...')
-        res = self.__fetch__(request)
+        if self.cache is None:
+            return self.__fetch__(request)
+
+        entry = self.__cached_get__(request)
+        if 204 == entry.status:
+            return True
+        res = { 'status': entry.status, 'data': entry.data }
 
         return res
 
@@ -181,16 +498,76 @@ class RestApi:
         res  = self.__fetch__(request, method = 'HEAD', return_response = True)
         return res.getheaders()
     
+    def __dispatch__(self, method, request, data = None):
+        method = method.upper()
+        if 'GET' == method:
+            return self.get(request)
+        elif 'POST' == method:
+            return self.post(request, data)
+        elif 'PATCH' == method:
+            return self.patch(request, data)
+        elif 'DELETE' == method:
+            return self.delete(request, data)
+        elif 'HEAD' == method:
+            return self.head(request)
+        raise ValueError('%s is an unsupported method' % method)
+
+    def batch(self, requests, workers = 8, max_in_flight = None):
+        """
+        Run a list of independent requests, each a (method, path) or
+        (method, path, data) tuple, concurrently across workers threads
+        over pooled connections. Returns the results in the same order as
+        requests; a request that failed has the exception it raised in
+        its place, and doesn't stop the rest of the batch. If
+        max_in_flight is given, no more than that many requests from
+        batches sharing this client's connection pool are outstanding
+        against the host at once; the first batch to give a limit for a
+        host sets it for the life of the pool.
+        """
+        requests = list(requests)
+        results  = [ None ] * len(requests)
+        pending  = Queue.Queue()
+        for i in range(len(requests)):
+            pending.put(i)
+
+        slots = None
+        if max_in_flight:
+            slots = self.pool.slots(self.api_base, max_in_flight)
+
+        def work():
+            while True:
+                try:
+                    i = pending.get_nowait()
+                except Queue.Empty:
+                    return
+
+                if slots:
+                    slots.acquire()
+                try:
+                    results[i] = self.__dispatch__(*requests[i])
+                except Exception as e:
+                    self.__trace__('batch request %d failed: %s' % (i, e),
+                                   err = True)
+                    results[i] = e
+                finally:
+                    if slots:
+                        slots.release()
+
+        threads = [ threading.Thread(target = work)
+                    for i in range(max(1, min(workers, len(requests)))) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
     def rate_limit(self):
-        res = self.__fetch__('/', return_response=True)
-        headers = res.getheaders()
-
-        remaining   = -1
-        limit       = -1
-
-        for header, value in headers:
-            if 'ratelimit-remaining' in header:
-                remaining = int(value)
-            elif 'ratelimit-limit' in header:
-                limit = int(value)
-        return remaining, limit
+        # only probe the API if no response has reported the quota yet
+        if not self.quota:
+            self.__fetch__('/', return_response=True)
+
+        if not self.quota:
+            return -1, -1
+        return self.quota
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# file: retry.py
+# author: kyle isom <coder@kyleisom.net>
+#
+# retry policy and circuit breaker for the rest interface
+
+import email.utils
+import random
+import threading
+import time
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of sending a request to a host whose circuit is open.
+    """
+
+    def __init__(self, host, retry_in):
+        Exception.__init__(self, '%s is failing; retry in %.1fs' % (host,
+                                                                    retry_in))
+        self.host     = host
+        self.retry_in = retry_in
+
+
+def parse_retry_after(value, now = None):
+    """
+    Convert a Retry-After header, either a number of seconds or an HTTP
+    date, to a number of seconds. Returns None if it can't be parsed.
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    date = email.utils.parsedate_tz(value)
+    if not date:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, email.utils.mktime_tz(date) - now)
+
+
+class RetryPolicy:
+    """
+    Decides whether a failed request should be retried and how long to
+    wait first. Waits grow exponentially from backoff up to max_backoff,
+    with full jitter; a Retry-After header from the server is honoured
+    instead, unless it asks for more than max_backoff, in which case the
+    request isn't retried. Only the methods listed in methods (by
+    default, the idempotent ones) are retried, so a POST is never sent
+    twice unless asked for.
+    """
+    retries     = None
+    backoff     = None
+    max_backoff = None
+    jitter      = None
+    statuses    = None
+    methods     = None
+
+    def __init__(self, retries = 3, backoff = 0.5, max_backoff = 30,
+                 jitter = True, statuses = (429, 502, 503, 504),
+                 methods = ('GET', 'HEAD', 'DELETE')):
+        self.retries     = retries
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+        self.jitter      = jitter
+        self.statuses    = statuses
+        self.methods     = methods
+
+    def allowed(self, method, attempt):
+        return method in self.methods and attempt < self.retries
+
+    def retry_status(self, method, attempt, status):
+        return self.allowed(method, attempt) and status in self.statuses
+
+    def delay(self, attempt, retry_after = None):
+        """
+        Return the number of seconds to wait before retrying, or None if
+        the server asked for a longer wait than this policy allows.
+        """
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            return retry_after
+
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. After threshold consecutive failures a
+    host's circuit opens and requests to it fail at once with CircuitOpen
+    for reset_timeout seconds. After that a single trial request is let
+    through: if it succeeds the circuit closes again, otherwise it stays
+    open for another reset_timeout.
+    """
+    threshold     = None
+    reset_timeout = None
+
+    def __init__(self, threshold = 5, reset_timeout = 30):
+        self.threshold     = threshold
+        self.reset_timeout = reset_timeout
+        self.__lock        = threading.Lock()
+        self.__hosts       = { }            # host -> [ failures, opened, trial ]
+
+    def before(self, host):
+        """
+        Called before each request; raises CircuitOpen if the request
+        shouldn't be sent.
+        """
+        now = time.time()
+        with self.__lock:
+            state = self.__hosts.get(host)
+            if not state or state[0] < self.threshold:
+                return
+
+            retry_in = state[1] + self.reset_timeout - now
+            if retry_in > 0 or state[2]:
+                raise CircuitOpen(host, max(retry_in, 0))
+            state[2] = True                           # let one trial through
+
+    def success(self, host):
+        with self.__lock:
+            self.__hosts.pop(host, None)
+
+    def failure(self, host):
+        with self.__lock:
+            state = self.__hosts.setdefault(host, [ 0, 0, False ])
+            state[0] += 1
+            if state[0] >= self.threshold:
+                state[1] = time.time()
+                state[2] = False
+
+    def state(self, host):
+        """
+        Return 'closed', 'open' or 'half-open' for a host.
+        """
+        with self.__lock:
+            state = self.__hosts.get(host)
+            if not state or state[0] < self.threshold:
+                return 'closed'
+            if state[2] or time.time() >= state[1] + self.reset_timeout:
+                return 'half-open'
+            return 'open'